@@ -0,0 +1,117 @@
+# Compares patch_audio_metadata() with the previous implementation, which
+# searched the tree for the Atmos property and the bandwidth on every
+# comparison of two tracks.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_audio_metadata
+
+import time
+from typing import *
+from xml.etree import ElementTree
+
+from resources.lib.mpd import find, findall, patch_audio_metadata, split_adaptation_sets
+
+from .manifests import synthetic_manifest
+
+TRACKS = [10, 50, 100, 200]
+REPRESENTATIONS = 4
+ROUNDS = 5
+
+
+def is_higher_quality(
+    a: ElementTree.Element, b: ElementTree.Element, prefer_atmos: bool
+) -> bool:
+    atmos_a = len(findall(a, ".//dash:SupplementalProperty[@value='JOC']")) > 0
+    atmos_b = len(findall(b, ".//dash:SupplementalProperty[@value='JOC']")) > 0
+
+    if atmos_a != atmos_b and prefer_atmos:
+        return atmos_a
+
+    bitrate_a = int(find(a, "./dash:Representation").get("bandwidth"))
+    bitrate_b = int(find(b, "./dash:Representation").get("bandwidth"))
+
+    return bitrate_a > bitrate_b
+
+
+def patch_audio_metadata_search(tree: ElementTree.Element, prefer_atmos: bool) -> int:
+    adsets = findall(tree, "./dash:AdaptationSet")
+
+    found = {}
+
+    for adset in adsets:
+        if adset.get("contentType") != "audio":
+            continue
+
+        track_id = adset.get("audioTrackId")
+        if track_id is None:
+            track_id = "audio"
+
+        if track_id not in found:
+            adset.set("default", "true")
+            found[track_id] = adset
+
+        elif is_higher_quality(adset, found[track_id], prefer_atmos):
+            adset.set("default", "true")
+            found[track_id].set("default", "false")
+            found[track_id] = adset
+
+        else:
+            adset.set("default", "false")
+
+        adset.remove(find(adset, "./dash:Role"))
+
+        if "descriptive" in track_id:
+            adset.set("impaired", "true")
+        else:
+            adset.set("impaired", "false")
+
+        bitrate = int(find(adset, "./dash:Representation").get("bandwidth"))
+        adset.set("name", "{:3d} kbps".format(bitrate // 1000))
+
+    return len(found)
+
+
+def measure(patch: Callable, manifest: str, prefer_atmos: bool) -> Tuple[float, str]:
+    best = None
+
+    for _ in range(ROUNDS):
+        tree = ElementTree.fromstring(manifest)
+        period = find(tree, "./*[dash:AdaptationSet]")
+        split_adaptation_sets(period)
+
+        start = time.perf_counter()
+        patch(period, prefer_atmos)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, ElementTree.tostring(tree, encoding="unicode")
+
+
+def main() -> None:
+    print(
+        "{:>6} {:>6} {:>12} {:>12} {:>8}".format(
+            "tracks", "atmos", "search", "index", "speedup"
+        )
+    )
+
+    for tracks in TRACKS:
+        manifest = synthetic_manifest(1, 1, tracks, REPRESENTATIONS)
+
+        for prefer_atmos in [True, False]:
+            old, old_txt = measure(patch_audio_metadata_search, manifest, prefer_atmos)
+            new, new_txt = measure(patch_audio_metadata, manifest, prefer_atmos)
+
+            if old_txt != new_txt:
+                raise Exception("Output differs for {} tracks".format(tracks))
+
+            print(
+                "{:>6} {:>6} {:>10.2f}ms {:>10.2f}ms {:>7.1f}x".format(
+                    tracks, str(prefer_atmos), old * 1000, new * 1000, old / new
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Compares the login form extraction with the previous implementation,
+# which parsed every login page into a full BeautifulSoup tree.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_login_forms
+
+import os
+import time
+import tracemalloc
+from typing import *
+
+from bs4 import BeautifulSoup
+
+from resources.lib.api.forms import find_form
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+PAGES = {
+    "signin.html": "signin",
+    "mfa.html": "mfa",
+    "error.html": "mfa",
+}
+ROUNDS = 20
+
+
+def form_inputs(inputs: Iterable) -> Dict:
+    data = {}
+
+    for field in inputs:
+        try:
+            data[field["name"]] = ""
+            if field["type"] and field["type"] == "hidden":
+                data[field["name"]] = field["value"]
+        except:
+            pass
+
+    return data
+
+
+def summary(form, inputs: Iterable) -> Tuple:
+    if form is None:
+        return None
+
+    return form.get("method", "GET"), form["action"], form_inputs(inputs)
+
+
+def is_mfa_form(attrs: Dict[str, str]) -> bool:
+    return "auth-mfa-form" in attrs.get("id", "")
+
+
+# Both do what AmazonLogin.login() needs from a page: the sign-in form
+# from the first page, and the first form and whether an MFA code is
+# required from every page after it
+def extract_soup(html: str, page: str) -> Tuple:
+    soup = BeautifulSoup(html, "html.parser")
+
+    if page == "signin":
+        form = soup.find("form", {"name": "signIn"})
+        return summary(form, form.find_all("input"))
+
+    if soup.find("form", id=lambda x: x and "auth-mfa-form" in x) is None:
+        return None
+
+    form = soup.find("form")
+    return summary(form, form.find_all("input"))
+
+
+def extract_parser(html: str, page: str) -> Tuple:
+    if page == "signin":
+        _, form = find_form(html, lambda attrs: attrs.get("name") == "signIn")
+        return summary(form, form.inputs)
+
+    form, mfa = find_form(html, is_mfa_form)
+    if mfa is None:
+        return None
+
+    return summary(form, form.inputs)
+
+
+def measure(extract: Callable, html: str, page: str) -> Tuple[float, int, Tuple]:
+    best = None
+
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = extract(html, page)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    extract(html, page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak, result
+
+
+def main() -> None:
+    print(
+        "{:<12} {:>8} {:>12} {:>12} {:>8} {:>12} {:>12}".format(
+            "page", "size", "soup", "parser", "speedup", "soup mem", "parser mem"
+        )
+    )
+
+    for name, page in PAGES.items():
+        with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+            html = f.read()
+
+        old, old_peak, old_result = measure(extract_soup, html, page)
+        new, new_peak, new_result = measure(extract_parser, html, page)
+
+        if old_result != new_result:
+            raise Exception("Results differ for {}".format(name))
+
+        print(
+            "{:<12} {:>6.0f}KiB {:>10.2f}ms {:>10.2f}ms {:>7.1f}x {:>9.0f}KiB {:>9.0f}KiB".format(
+                name,
+                len(html) / 1024,
+                old * 1000,
+                new * 1000,
+                old / new,
+                old_peak / 1024,
+                new_peak / 1024,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
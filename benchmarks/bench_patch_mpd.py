@@ -0,0 +1,203 @@
+# Measures patch_mpd() and stream_mpd() on synthetic manifests.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_patch_mpd --periods 4 --audio 20 --output run.json
+#
+# Timings are taken without tracemalloc, because tracing slows down the
+# code a lot. Peak memory is measured in a separate, traced round.
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from typing import *
+
+from resources.lib.mpd import PIPELINE, PatchOptions, patch_mpd, stream_mpd
+from resources.lib.pipeline import Pipeline, Stage
+
+from .manifests import synthetic_manifest, synthetic_subtitles
+
+URL = "https://cdn.example.com/video/manifest.mpd"
+CHUNK_SIZE = 64 * 1024
+
+
+def traced(stage: Stage, peaks: Dict[str, int]) -> Stage:
+    def func(parent, options) -> int:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+
+        count = stage.func(parent, options)
+
+        peak = tracemalloc.get_traced_memory()[1] - start
+        peaks[stage.name] = max(peaks.get(stage.name, 0), peak)
+
+        return count
+
+    return Stage(stage.name, func)
+
+
+def run_tree(manifest: str, options: PatchOptions, pipeline: Pipeline) -> str:
+    return patch_mpd(manifest, options, pipeline)
+
+
+def run_stream(manifest: str, options: PatchOptions, pipeline: Pipeline) -> str:
+    data = manifest.encode()
+    chunks = (data[i : i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+
+    return "".join(stream_mpd(chunks, options, pipeline))
+
+
+ENGINES = {
+    "tree": run_tree,
+    "stream": run_stream,
+}
+
+
+def new_options(args: argparse.Namespace) -> PatchOptions:
+    subs = synthetic_subtitles(args.subs)
+    forced = synthetic_subtitles(args.forced, forced=True)
+
+    return PatchOptions(URL, subs, forced, True, set(args.skip))
+
+
+def bench(engine: str, manifest: str, args: argparse.Namespace) -> Dict:
+    run = ENGINES[engine]
+
+    times = []
+    stages = {}
+    output = None
+
+    for _ in range(args.rounds):
+        pipeline = Pipeline(PIPELINE.stages)
+        options = new_options(args)
+
+        start = time.perf_counter()
+        output = run(manifest, options, pipeline)
+        times.append(time.perf_counter() - start)
+
+        for name, stats in pipeline.stats().items():
+            stage = stages.setdefault(name, {"time": [], "elements": 0})
+            stage["time"].append(stats["time"])
+            stage["elements"] = stats["elements"]
+
+    # One more round with tracemalloc, to find the peak memory
+    # of the whole run and of the single stages
+    peaks = {}
+    pipeline = Pipeline([traced(stage, peaks) for stage in PIPELINE.stages])
+
+    tracemalloc.start()
+    run(manifest, new_options(args), pipeline)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "time": min(times),
+        "peak_memory": peak,
+        "output_size": len(output.encode()),
+        "stages": {
+            name: {
+                "time": min(stage["time"]),
+                "elements": stage["elements"],
+                "peak_memory": peaks.get(name),
+            }
+            for name, stage in stages.items()
+        },
+        "output": output,
+    }
+
+
+def print_result(engine: str, result: Dict) -> None:
+    print(
+        "{}: {:.2f}ms, peak {:.1f} KiB, output {:.1f} KiB".format(
+            engine,
+            result["time"] * 1000,
+            result["peak_memory"] / 1024,
+            result["output_size"] / 1024,
+        )
+    )
+
+    for name, stage in result["stages"].items():
+        peak = stage["peak_memory"]
+        peak = "-" if peak is None else "{:.1f} KiB".format(peak / 1024)
+
+        print(
+            "  {:<24} {:>9.2f}ms {:>8} elements {:>12}".format(
+                name, stage["time"] * 1000, stage["elements"], peak
+            )
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--periods", type=int, default=1)
+    parser.add_argument("--video", type=int, default=8, help="video representations")
+    parser.add_argument("--audio", type=int, default=12, help="audio tracks")
+    parser.add_argument("--reps", type=int, default=4, help="representations per track")
+    parser.add_argument("--subs", type=int, default=30, help="subtitle tracks")
+    parser.add_argument("--forced", type=int, default=10, help="forced narratives")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--engine", choices=list(ENGINES) + ["all"], default="all"
+    )
+    parser.add_argument("--skip", nargs="*", default=[], choices=PIPELINE.names())
+    parser.add_argument("--output", help="write the results to this JSON file")
+
+    return parser.parse_args()
+
+
+def write_report(
+    args: argparse.Namespace, manifest: str, identical: bool, results: Dict
+) -> None:
+    report = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {
+            "periods": args.periods,
+            "video": args.video,
+            "audio": args.audio,
+            "reps": args.reps,
+            "subs": args.subs,
+            "forced": args.forced,
+            "rounds": args.rounds,
+            "skip": args.skip,
+            "manifest_size": len(manifest.encode()),
+        },
+        "identical": identical,
+        "engines": results,
+    }
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def main() -> None:
+    args = parse_args()
+    engines = list(ENGINES) if args.engine == "all" else [args.engine]
+
+    manifest = synthetic_manifest(args.periods, args.video, args.audio, args.reps)
+    print("Manifest: {:.1f} KiB".format(len(manifest.encode()) / 1024))
+
+    results = {}
+    for engine in engines:
+        results[engine] = bench(engine, manifest, args)
+        print_result(engine, results[engine])
+
+    # The synthetic manifests declare the xsi, mspr and cenc namespaces
+    # like the ones from Amazon, so this also checks that both engines
+    # declare and prefix them the same way
+    outputs = set(result.pop("output") for result in results.values())
+    identical = len(outputs) == 1
+    print("Identical output: {}".format("yes" if identical else "NO"))
+
+    if args.output is not None:
+        write_report(args, manifest, identical, results)
+
+    if not identical:
+        raise Exception("The engines produced different output")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Shows how patching scales with the number of periods. The time per
+# period should stay roughly the same, no matter how many there are.
+# The last column is the time until the streaming patcher produced its
+# first chunk, which is when IS.A receives the response headers.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_periods
+
+import time
+from typing import *
+
+from resources.lib.mpd import PatchOptions, patch_mpd, stream_mpd
+
+from .manifests import synthetic_manifest, synthetic_subtitles
+
+PERIODS = [1, 10, 50, 100, 300]
+ROUNDS = 3
+
+URL = "https://cdn.example.com/video/manifest.mpd"
+CHUNK_SIZE = 64 * 1024
+
+
+def measure(engine: Callable[[str, PatchOptions], str], manifest: str) -> float:
+    best = None
+
+    for _ in range(ROUNDS):
+        options = PatchOptions(URL, synthetic_subtitles(10), [], True)
+
+        start = time.perf_counter()
+        engine(manifest, options)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def tree(manifest: str, options: PatchOptions) -> str:
+    return patch_mpd(manifest, options)
+
+
+def stream(manifest: str, options: PatchOptions) -> str:
+    return "".join(stream_mpd([manifest.encode()], options))
+
+
+# The manifest arrives in chunks like it does from the CDN
+def first_chunk(manifest: str, options: PatchOptions) -> str:
+    data = manifest.encode()
+    chunks = (data[i : i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+
+    return next(stream_mpd(chunks, options))
+
+
+def main() -> None:
+    print(
+        "{:>8} {:>10} {:>12} {:>12} {:>14} {:>12}".format(
+            "periods", "size", "tree", "stream", "tree/period", "first chunk"
+        )
+    )
+
+    for periods in PERIODS:
+        manifest = synthetic_manifest(periods, 6, 8, 3)
+
+        t = measure(tree, manifest)
+        s = measure(stream, manifest)
+        f = measure(first_chunk, manifest)
+
+        print(
+            "{:>8} {:>8.0f}KiB {:>10.2f}ms {:>10.2f}ms {:>12.3f}ms {:>10.3f}ms".format(
+                periods,
+                len(manifest) / 1024,
+                t * 1000,
+                s * 1000,
+                t * 1000 / periods,
+                f * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Compares split_adaptation_sets() with the previous implementation, which
+# deep-copied the whole adaptation set once per representation.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_split
+
+import copy
+import time
+from typing import *
+from xml.etree import ElementTree
+
+from resources.lib.mpd import find, findall, split_adaptation_sets
+
+from .manifests import audio_manifest
+
+REPRESENTATIONS = [10, 50, 100, 200]
+TRACKS = 4
+ROUNDS = 5
+
+
+def split_adaptation_sets_deepcopy(tree: ElementTree.Element) -> None:
+    adsets = findall(tree, "./dash:AdaptationSet")
+
+    for adset in adsets:
+        if adset.get("contentType") != "audio":
+            continue
+
+        reps = findall(adset, "./dash:Representation")
+
+        for i in range(0, len(reps)):
+            cp_adset = copy.deepcopy(adset)
+            cp_reps = findall(cp_adset, "./dash:Representation")
+
+            for j in range(0, len(reps)):
+                if i == j:
+                    continue
+
+                cp_adset.remove(cp_reps[j])
+
+            if "minBandwidth" in cp_adset.attrib:
+                del cp_adset.attrib["minBandwidth"]
+
+            if "maxBandwidth" in cp_adset.attrib:
+                del cp_adset.attrib["maxBandwidth"]
+
+            tree.append(cp_adset)
+
+        tree.remove(adset)
+
+
+def measure(split: Callable, manifest: str) -> Tuple[float, str]:
+    best = None
+
+    for _ in range(ROUNDS):
+        tree = ElementTree.fromstring(manifest)
+        period = find(tree, "./*[dash:AdaptationSet]")
+
+        start = time.perf_counter()
+        split(period)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, ElementTree.tostring(tree, encoding="unicode")
+
+
+def main() -> None:
+    print("{:>6} {:>12} {:>12} {:>8}".format("reps", "deepcopy", "linear", "speedup"))
+
+    for reps in REPRESENTATIONS:
+        manifest = audio_manifest(TRACKS, reps)
+
+        old, old_txt = measure(split_adaptation_sets_deepcopy, manifest)
+        new, new_txt = measure(split_adaptation_sets, manifest)
+
+        if old_txt != new_txt:
+            raise Exception("Output differs for {} representations".format(reps))
+
+        print(
+            "{:>6} {:>10.2f}ms {:>10.2f}ms {:>7.1f}x".format(
+                reps, old * 1000, new * 1000, old / new
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Reports what the plugin imports on startup, for the play and the login
+# path, using the output of python -X importtime.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_startup --top 15 --output startup.json
+#
+# The Kodi modules don't exist outside of Kodi, so empty placeholders are
+# put in front of the module path. Their import time is not meaningful.
+# Exits with an error if a path imports a module it should not need.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import *
+
+PATHS = {
+    "play": "from resources.lib.playback import play",
+    "login": "from resources.lib.auth import login",
+}
+
+# Modules that must not be imported on a path
+FORBIDDEN = {
+    "play": [
+        "bottle",
+        "bs4",
+        "dateutil",
+        "resources.lib.api.login",
+        "resources.lib.proxy",
+    ],
+    "login": ["bottle", "bs4", "inputstreamhelper", "resources.lib.proxy"],
+}
+
+KODI_MODULES = {
+    "xbmc": "LOGDEBUG = 0\nLOGINFO = 1\nLOGWARNING = 2\nLOGERROR = 3\n",
+    "xbmcaddon": "class Addon:\n    pass\n",
+    "xbmcgui": "",
+    "xbmcplugin": "",
+    "xbmcvfs": "",
+    "inputstreamhelper": "class Helper:\n    pass\n",
+}
+
+
+class Import:
+    name: str
+    self_time: int
+    cumulative: int
+    depth: int
+
+    def __init__(self, name: str, self_time: int, cumulative: int, depth: int):
+        self.name = name
+        self.self_time = self_time
+        self.cumulative = cumulative
+        self.depth = depth
+
+
+def parse_importtime(output: str) -> List[Import]:
+    imports = []
+
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        imports.append(Import(name.strip(), int(self_time), int(cumulative), depth))
+
+    return imports
+
+
+def run_path(code: str, stubs: str) -> List[Import]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([stubs, os.getcwd()])
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+
+    if proc.returncode != 0:
+        raise Exception("Import failed:\n{}".format(proc.stderr))
+
+    return parse_importtime(proc.stderr)
+
+
+def write_stubs(path: str) -> None:
+    for name, code in KODI_MODULES.items():
+        with open(os.path.join(path, name + ".py"), "w", encoding="utf-8") as f:
+            f.write(code)
+
+
+# Modules that the interpreter itself imports on startup
+# are not counted, and neither are the Kodi placeholders
+def report(name: str, imports: List[Import], startup: Set[str], top: int) -> Dict:
+    ignored = set(KODI_MODULES)
+    imports = [
+        i
+        for i in imports
+        if i.name not in startup and i.name.split(".")[0] not in ignored
+    ]
+
+    # Only the top level imports add up to the total
+    total = sum(i.cumulative for i in imports if i.depth == 0)
+    names = set(i.name for i in imports)
+
+    forbidden = [
+        module
+        for module in FORBIDDEN[name]
+        if any(n == module or n.startswith(module + ".") for n in names)
+    ]
+
+    slowest = sorted(imports, key=lambda i: i.self_time, reverse=True)[:top]
+
+    print("{}: {:.1f}ms, {} modules".format(name, total / 1000, len(imports)))
+    for i in slowest:
+        print("  {:<48} {:>8.2f}ms".format(i.name, i.self_time / 1000))
+
+    for module in forbidden:
+        print("  imports {}, which it should not need".format(module))
+
+    return {
+        "total": total,
+        "modules": len(imports),
+        "forbidden": forbidden,
+        "slowest": {i.name: i.self_time for i in slowest},
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", choices=list(PATHS) + ["all"], default="all")
+    parser.add_argument("--top", type=int, default=10, help="slowest modules to show")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--output", help="write the results to this JSON file")
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    paths = list(PATHS) if args.path == "all" else [args.path]
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as stubs:
+        write_stubs(stubs)
+        startup = set(i.name for i in run_path("pass", stubs))
+
+        for name in paths:
+            # The fastest round is the one least affected by a cold disk cache
+            runs = [run_path(PATHS[name], stubs) for _ in range(args.rounds)]
+            best = min(runs, key=lambda imports: sum(i.self_time for i in imports))
+
+            results[name] = report(name, best, startup, args.top)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if any(result["forbidden"] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
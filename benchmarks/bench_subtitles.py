@@ -0,0 +1,90 @@
+# Checks convert_ttml() against the expected output for the subtitles in
+# benchmarks/fixtures, and measures how fast it converts a long track.
+# The fixture covers time containers, styles that are referenced by ID
+# and inline styles.
+#
+# Run from the root of the repository:
+#
+#   python -m benchmarks.bench_subtitles
+
+import os
+import time
+from typing import *
+
+from resources.lib.subtitles import FORMATS, convert_ttml
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+CUES = [100, 1000, 5000]
+CHUNK_SIZE = 64 * 1024
+ROUNDS = 5
+
+HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<tt xmlns="http://www.w3.org/ns/ttml"'
+    ' xmlns:tts="http://www.w3.org/ns/ttml#styling" xml:lang="en">\n'
+    '  <head><styling><style xml:id="s1" tts:fontStyle="italic"/></styling></head>\n'
+    "  <body><div>\n"
+)
+
+CUE = (
+    '    <p begin="{0}.000s" end="{0}.800s">Line {0} &amp; more<br/>'
+    '<span style="s1">second</span> line</p>\n'
+)
+
+
+def chunked(data: bytes) -> Iterator[bytes]:
+    for i in range(0, len(data), CHUNK_SIZE):
+        yield data[i : i + CHUNK_SIZE]
+
+
+def check() -> None:
+    with open(os.path.join(FIXTURES, "subtitles.ttml"), "rb") as f:
+        ttml = f.read()
+
+    for fmt in FORMATS:
+        with open(os.path.join(FIXTURES, "subtitles." + fmt), encoding="utf-8") as f:
+            expected = f.read()
+
+        # Tiny chunks, so that elements are split between them
+        chunks = (ttml[i : i + 7] for i in range(0, len(ttml), 7))
+        output = "".join(convert_ttml(chunks, fmt))
+
+        if output != expected:
+            raise Exception("Unexpected {} output for subtitles.ttml".format(fmt))
+
+    print("Fixture: ok")
+
+
+def synthetic_ttml(cues: int) -> bytes:
+    out = [HEADER]
+    out.extend(CUE.format(i) for i in range(cues))
+    out.append("  </div></body>\n</tt>\n")
+
+    return "".join(out).encode()
+
+
+def main() -> None:
+    check()
+
+    print("{:>6} {:>10} {:>12} {:>14}".format("cues", "size", "vtt", "cues/s"))
+
+    for cues in CUES:
+        ttml = synthetic_ttml(cues)
+        best = None
+
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            "".join(convert_ttml(chunked(ttml), "vtt"))
+            elapsed = time.perf_counter() - start
+
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "{:>6} {:>8.0f}KiB {:>10.2f}ms {:>14.0f}".format(
+                cues, len(ttml) / 1024, best * 1000, cues / best
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+from typing import *
+
+# Declares the same namespaces as the manifests from Amazon. Both engines
+# must number the PlayReady namespace, which ElementTree doesn't know,
+# the same way, see MPDWriter.
+HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013"'
+    ' xmlns:mspr="urn:microsoft:playready"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    ' xsi:schemaLocation="urn:mpeg:dash:schema:mpd:2011 DASH-MPD.xsd"'
+    ' type="static" mediaPresentationDuration="PT1H">\n'
+)
+
+CONTENT_PROTECTION = (
+    '      <ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011"'
+    ' value="cenc" cenc:default_KID="00000000-0000-0000-0000-000000000000" />\n'
+)
+
+PLAYREADY = (
+    "      <ContentProtection"
+    ' schemeIdUri="urn:uuid:9a04f079-9840-4286-ab92-e65be0885f95" value="MSPR 2.0">\n'
+    "        <cenc:pssh>AAAAQHBzc2g=</cenc:pssh>\n"
+    "        <mspr:pro>AAAAQHBzc2g=</mspr:pro>\n"
+    "      </ContentProtection>\n"
+)
+
+JOC = (
+    '<SupplementalProperty schemeIdUri="tag:dolby.com,2018:dash:'
+    'EC3_ExtensionType:2018" value="JOC" />'
+)
+
+LANGUAGES = ["en", "de", "fr", "es", "it", "ja", "pt-br", "es-419", "fr-ca"]
+
+
+def video_adaptation_set(period: int, reps: int) -> str:
+    out = [
+        '    <AdaptationSet contentType="video" mimeType="video/mp4"'
+        ' segmentAlignment="true">\n',
+        CONTENT_PROTECTION,
+        PLAYREADY,
+        '      <SegmentTemplate timescale="24000" media="video_{0}_$Number$.mp4"'
+        ' initialization="video_{0}_init.mp4" />\n'.format(period),
+    ]
+
+    for i in range(reps):
+        out.append(
+            '      <Representation id="v{0}_{1}" bandwidth="{2}" codecs="hvc1"'
+            ' width="3840" height="2160" />\n'.format(period, i, 1000000 * (i + 1))
+        )
+
+    out.append("    </AdaptationSet>\n")
+    return "".join(out)
+
+
+def audio_adaptation_set(
+    index: int, reps: int, track_id: str = None, atmos: bool = False
+) -> str:
+    if track_id is None:
+        track_id = "en_dialog{}".format(index)
+
+    lang = track_id.split("_")[0]
+
+    out = [
+        '    <AdaptationSet contentType="audio" mimeType="audio/mp4" lang="{}"'
+        ' audioTrackId="{}" minBandwidth="64000" maxBandwidth="768000">\n'.format(
+            lang, track_id
+        ),
+        CONTENT_PROTECTION,
+        '      <Role schemeIdUri="urn:mpeg:dash:role:2011" value="main" />\n',
+    ]
+
+    for i in range(reps):
+        # Atmos tracks have a lower bitrate than the best 5.1 track
+        props = JOC if atmos and i == 0 else ""
+
+        out.append(
+            '      <Representation id="a{0}_{1}" bandwidth="{2}" codecs="ec-3">'
+            '{3}<BaseURL>audio_{0}_{1}.mp4</BaseURL>'
+            '<SegmentBase indexRange="0-1000" /></Representation>\n'.format(
+                index, i, 64000 + i * 1000, props
+            )
+        )
+
+    out.append("    </AdaptationSet>\n")
+    return "".join(out)
+
+
+# A single period with one audio adaptation set per track,
+# each of them containing reps representations
+def audio_manifest(tracks: int, reps: int) -> str:
+    out = [HEADER, '  <Period id="0">\n']
+
+    for i in range(tracks):
+        out.append(audio_adaptation_set(i, reps))
+
+    out.append("  </Period>\n</MPD>\n")
+    return "".join(out)
+
+
+# Every period gets one video adaptation set and one audio adaptation
+# set per track. Tracks cycle through the languages, every third track
+# is an audio description and every fourth one has an Atmos stream.
+def synthetic_manifest(periods: int, video: int, audio: int, reps: int) -> str:
+    out = [HEADER, "  <BaseURL>https://cdn.example.com/</BaseURL>\n"]
+
+    for period in range(periods):
+        out.append(
+            '  <Period id="{0}" start="PT{1}S">\n'
+            "    <BaseURL>period_{0}/</BaseURL>\n".format(period, period * 600)
+        )
+        out.append(video_adaptation_set(period, video))
+
+        for i in range(audio):
+            lang = LANGUAGES[i % len(LANGUAGES)]
+            kind = "descriptive" if i % 3 == 2 else "dialog"
+            track_id = "{}_{}".format(lang, kind)
+
+            index = period * audio + i
+            out.append(audio_adaptation_set(index, reps, track_id, i % 4 == 0))
+
+        out.append("  </Period>\n")
+
+    out.append("</MPD>\n")
+    return "".join(out)
+
+
+def synthetic_subtitles(count: int, forced: bool = False) -> List[Dict[str, str]]:
+    subs = []
+
+    for i in range(count):
+        kind = "forced" if forced else "sub"
+
+        subs.append(
+            {
+                "languageCode": LANGUAGES[i % len(LANGUAGES)],
+                "timedTextTrackId": "{}{}".format(kind, i),
+                "url": "https://cdn.example.com/{}{}.ttml2".format(kind, i),
+            }
+        )
+
+    return subs
@@ -1,13 +1,16 @@
 import sys
 from urllib.parse import parse_qsl, urlparse
 
-from resources.lib.auth import login
-from resources.lib.playback import play
-
+# Kodi starts a new interpreter for every invocation, so every
+# action only imports what it needs. See benchmarks/bench_startup.py.
 query = urlparse(sys.argv[2]).query
 args = dict(parse_qsl(query))
 
 if "play" in args:
+    from resources.lib.playback import play
+
     play(args["play"])
 else:
+    from resources.lib.auth import login
+
     login()
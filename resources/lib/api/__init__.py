@@ -1,5 +1,16 @@
 from .auth import AmazonAuth
 from .constants import *
-from .login import AmazonLogin
-from .token import AmazonToken
+from .session import get_cdn_session, get_session, new_session
+from .token import AmazonToken, token_time
 from .url import AmazonURL
+
+
+# The login is only imported when it is used, because everything else
+# imports this package and doesn't need it
+def __getattr__(name: str):
+    if name == "AmazonLogin":
+        from .login import AmazonLogin
+
+        return AmazonLogin
+
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
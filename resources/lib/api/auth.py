@@ -3,9 +3,9 @@ from typing import *
 
 import requests
 import requests.auth
-import dateutil.parser
 
 from .constants import *
+from .session import get_session
 from .token import AmazonToken
 from .url import AmazonURL
 
@@ -28,8 +28,8 @@ class AmazonAuth(requests.auth.AuthBase):
         self.use_cookies = use_cookies
         self.on_save = on_save
 
-    def refresh_oauth(self) -> None:
-        if not self.token.oauth_expired():
+    def refresh_oauth(self, margin: float = 0) -> None:
+        if not self.token.oauth_expired(margin):
             return
 
         req = {
@@ -40,7 +40,7 @@ class AmazonAuth(requests.auth.AuthBase):
             "requested_token_type": "access_token",
         }
 
-        resp = requests.post(self.url.token(), headers=HEADERS, json=req)
+        resp = get_session().post(self.url.token(), json=req)
         if resp.status_code != 200:
             raise Exception("Token refresh failed")
 
@@ -53,8 +53,8 @@ class AmazonAuth(requests.auth.AuthBase):
         ).timestamp()
         self.on_save(self.token)
 
-    def refresh_cookies(self) -> None:
-        if not self.token.cookies_expired():
+    def refresh_cookies(self, margin: float = 0) -> None:
+        if not self.token.cookies_expired(margin):
             return
 
         req = {
@@ -66,12 +66,16 @@ class AmazonAuth(requests.auth.AuthBase):
             "domain": "." + self.url.domain,
         }
 
-        resp = requests.post(self.url.cookies(), headers=HEADERS, data=req)
+        resp = get_session().post(self.url.cookies(), data=req)
         if resp.status_code != 200:
             raise Exception("Cookie refresh failed")
 
         data = resp.json()
 
+        # Slow to import and only needed here, which
+        # most plugin invocations never get to
+        import dateutil.parser
+
         cookies = {}
         for c in data["response"]["tokens"]["cookies"][req["domain"]]:
             time = dateutil.parser.parse(c["Expires"])
@@ -85,6 +89,30 @@ class AmazonAuth(requests.auth.AuthBase):
         self.token.cookies = cookies
         self.on_save(self.token)
 
+    # Refreshes whatever get_headers() is going to use
+    def refresh(self, margin: float = 0) -> None:
+        if self.token is None:
+            return
+
+        if self.token.access is not None and not self.use_cookies:
+            self.refresh_oauth(margin)
+
+        if self.token.cookies is not None and self.use_cookies:
+            self.refresh_cookies(margin)
+
+    # When whatever get_headers() is going to use expires
+    def expiry(self) -> Optional[float]:
+        if self.token is None:
+            return None
+
+        if self.token.access is not None and not self.use_cookies:
+            return self.token.expires
+
+        if self.token.cookies is not None and self.use_cookies:
+            return self.token.cookies_expiry()
+
+        return None
+
     def get_headers(self) -> Dict[str, str]:
         if self.token is None:
             return {}
@@ -0,0 +1,90 @@
+from html.parser import HTMLParser
+from typing import *
+
+# The login pages are fed to the parser in pieces of this size,
+# so that parsing can stop right after the interesting form
+CHUNK_SIZE = 16 * 1024
+
+
+class Form:
+    attrs: Dict[str, str]
+    inputs: List[Dict[str, str]]
+
+    def __init__(self, attrs: Dict[str, str]):
+        self.attrs = attrs
+        self.inputs = []
+
+    def get(self, name: str, default: str = None) -> str:
+        return self.attrs.get(name, default)
+
+    def __getitem__(self, name: str) -> str:
+        return self.attrs[name]
+
+
+# Collects the forms of a page and their inputs, until a form that
+# matches is complete. Everything else on the page is skipped.
+class FormParser(HTMLParser):
+    match: Callable[[Dict[str, str]], bool]
+    forms: List[Form]
+    current: Form
+    found: Form
+
+    def __init__(self, match: Callable[[Dict[str, str]], bool]):
+        super().__init__()
+
+        self.match = match
+        self.forms = []
+        self.current = None
+        self.found = None
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
+        if tag == "form" and self.current is None:
+            self.current = Form(attributes(attrs))
+        elif tag == "input" and self.current is not None:
+            self.current.inputs.append(attributes(attrs))
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "form" and self.current is not None:
+            self.finish()
+
+    def finish(self) -> None:
+        form = self.current
+        self.current = None
+
+        self.forms.append(form)
+
+        if self.found is None and self.match(form.attrs):
+            self.found = form
+
+    def close(self) -> None:
+        super().close()
+
+        # An unclosed form runs until the end of the page
+        if self.current is not None:
+            self.finish()
+
+
+# Attributes without a value are empty strings, like in BeautifulSoup
+def attributes(attrs: List[Tuple[str, str]]) -> Dict[str, str]:
+    return {name: "" if value is None else value for name, value in attrs}
+
+
+# Returns the first form of the page and the first form that matches
+def find_form(
+    html: str, match: Callable[[Dict[str, str]], bool] = lambda attrs: True
+) -> Tuple[Optional[Form], Optional[Form]]:
+    parser = FormParser(match)
+
+    for i in range(0, len(html), CHUNK_SIZE):
+        parser.feed(html[i : i + CHUNK_SIZE])
+
+        if parser.found is not None:
+            break
+    else:
+        parser.close()
+
+    first = parser.forms[0] if len(parser.forms) > 0 else None
+    return first, parser.found
@@ -8,9 +8,10 @@ from urllib.parse import parse_qs, urlencode, urlparse
 
 import dateutil.parser
 import requests
-from bs4 import BeautifulSoup
 
 from .constants import *
+from .forms import Form, find_form
+from .session import get_session, new_session
 from .token import AmazonToken
 from .url import AmazonURL
 
@@ -37,8 +38,7 @@ class AmazonLogin:
         self.serial = serial
         self.callback_2fa = callback_2fa
 
-        self.session = requests.Session()
-        self.session.headers.update(HEADERS)
+        self.session = new_session()
 
     def create_code_verifier(self) -> bytes:
         verifier = secrets.token_bytes(32)
@@ -77,10 +77,10 @@ class AmazonLogin:
 
         return self.url.signin() + "?" + urlencode(params), verifier
 
-    def get_form_inputs(self, form) -> Dict:
+    def get_form_inputs(self, form: Form) -> Dict:
         data = {}
 
-        for field in form.find_all("input"):
+        for field in form.inputs:
             try:
                 data[field["name"]] = ""
                 if field["type"] and field["type"] == "hidden":
@@ -94,9 +94,8 @@ class AmazonLogin:
         url, verifier = self.build_oauth()
 
         resp = self.session.get(url)
-        soup = BeautifulSoup(resp.text, "html.parser")
+        _, form = find_form(resp.text, lambda attrs: attrs.get("name") == "signIn")
 
-        form = soup.find("form", {"name": "signIn"})
         data = self.get_form_inputs(form)
 
         data["email"] = self.username
@@ -106,10 +105,9 @@ class AmazonLogin:
         action = form["action"]
 
         resp = self.session.request(method, action, data=data)
-        soup = BeautifulSoup(resp.text, "html.parser")
+        form, mfa = find_form(resp.text, self.is_2fa_form)
 
-        while self.check_2fa(soup):
-            form = soup.find("form")
+        while mfa is not None:
             data = self.get_form_inputs(form)
 
             data["otpCode"] = self.callback_2fa()
@@ -120,7 +118,7 @@ class AmazonLogin:
             action = form["action"]
 
             resp = self.session.request(method, action, data=data)
-            soup = BeautifulSoup(resp.text, "html.parser")
+            form, mfa = find_form(resp.text, self.is_2fa_form)
 
         self.session.close()
         parsed_url = parse_qs(urlparse(resp.url).query)
@@ -132,11 +130,8 @@ class AmazonLogin:
 
         return self.register(verifier, auth_code)
 
-    def check_2fa(self, soup: BeautifulSoup) -> bool:
-        if soup.find("form", id=lambda x: x and "auth-mfa-form" in x):
-            return True
-
-        return False
+    def is_2fa_form(self, attrs: Dict[str, str]) -> bool:
+        return "auth-mfa-form" in attrs.get("id", "")
 
     def register(self, verifier: bytes, auth_code: str) -> AmazonToken:
         data = {
@@ -170,7 +165,7 @@ class AmazonLogin:
             },
         }
 
-        resp = requests.post(self.url.register(), headers=HEADERS, json=data)
+        resp = get_session().post(self.url.register(), json=data)
 
         if resp.status_code != 200:
             raise Exception("Device registration failed.")
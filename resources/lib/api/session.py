@@ -0,0 +1,96 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import *
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+from .constants import *
+
+# Most requests go to a handful of Amazon and CDN hosts, so keep a
+# few connections per host open instead of a new TLS handshake each time
+POOL_CONNECTIONS = 8
+POOL_MAXSIZE = 16
+
+# Connection errors are retried for every method. Read errors and
+# server errors only for requests that are safe to repeat.
+RETRIES = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=[500, 502, 503, 504],
+    allowed_methods=["GET", "HEAD", "OPTIONS"],
+    raise_on_status=False,
+)
+
+# Requests that don't pass their own timeout give up on a connection
+# after CONNECT_TIMEOUT seconds, and on a response that stops arriving
+# after READ_TIMEOUT seconds without data
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+
+class TimeoutAdapter(requests.adapters.HTTPAdapter):
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+adapter = TimeoutAdapter(
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=RETRIES,
+)
+
+# Requests to the CDNs are not retried, because the proxy falls back to
+# another CDN instead, which is faster than waiting for the same one
+cdn_adapter = TimeoutAdapter(
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=0,
+)
+
+session = None
+cdn_session = None
+lock = threading.Lock()
+
+
+# Creates a session with its own cookie jar, that shares the
+# connection pool with all other sessions
+def new_session(
+    adapter: requests.adapters.HTTPAdapter = adapter,
+) -> requests.Session:
+    s = requests.Session()
+    s.headers.update(HEADERS)
+
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+
+    return s
+
+
+# The session shared by all API calls and the proxy. It doesn't keep
+# cookies, because it is used for different accounts and endpoints.
+def get_session() -> requests.Session:
+    global session
+
+    with lock:
+        if session is None:
+            session = new_session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        return session
+
+
+# Like get_session(), but for the CDNs, see cdn_adapter
+def get_cdn_session() -> requests.Session:
+    global cdn_session
+
+    with lock:
+        if cdn_session is None:
+            cdn_session = new_session(cdn_adapter)
+            cdn_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        return cdn_session
@@ -2,12 +2,21 @@ from datetime import datetime, timedelta
 from typing import *
 
 
+# The expiry times are stored as timestamps of UTC dates in local time,
+# so they are compared to the current time in the same form
+def token_time(margin: float = 0) -> float:
+    return (datetime.utcnow() + timedelta(seconds=margin)).timestamp()
+
+
 class AmazonToken:
     access: str
     refresh: str
     expires: float
     cookies: Dict[str, str]
 
+    expiry: float
+    expiry_cookies: Dict[str, str]
+
     def __init__(
         self,
         access: str,
@@ -20,14 +29,39 @@ class AmazonToken:
         self.expires = expires
         self.cookies = cookies
 
-    def oauth_expired(self) -> bool:
-        return datetime.fromtimestamp(self.expires) <= datetime.utcnow()
+        self.expiry_cookies = None
+        self.expiry = None
+
+    @staticmethod
+    def from_dict(data: Dict) -> "AmazonToken":
+        return AmazonToken(
+            data["access"], data["refresh"], data["expires"], data["cookies"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "access": self.access,
+            "refresh": self.refresh,
+            "expires": self.expires,
+            "cookies": self.cookies,
+        }
+
+    # The time the first cookie expires. Only computed again
+    # when the cookies are replaced by a refresh.
+    def cookies_expiry(self) -> Optional[float]:
+        if self.expiry_cookies is not self.cookies:
+            expiries = [c["expires"] for c in self.cookies.values()]
+
+            self.expiry = min(expiries) if len(expiries) > 0 else None
+            self.expiry_cookies = self.cookies
 
-    def cookies_expired(self) -> bool:
-        for c in self.cookies:
-            date = datetime.fromtimestamp(self.cookies[c]["expires"])
+        return self.expiry
 
-            if date <= datetime.utcnow():
-                return True
+    # With a margin, tokens that expire within the
+    # next margin seconds are considered expired too
+    def oauth_expired(self, margin: float = 0) -> bool:
+        return self.expires <= token_time(margin)
 
-        return False
+    def cookies_expired(self, margin: float = 0) -> bool:
+        expiry = self.cookies_expiry()
+        return expiry is not None and expiry <= token_time(margin)
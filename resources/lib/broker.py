@@ -0,0 +1,60 @@
+import threading
+from typing import *
+
+from .api import AmazonAuth, AmazonToken, AmazonURL
+from .utils import read_token_file, remove_token_file, write_token_file
+
+
+# Owns the current token inside the service. All reads are served from
+# memory, and all writes and refreshes happen under one lock, so that
+# concurrent plugin invocations never refresh the token twice or write
+# the token file at the same time.
+class TokenBroker:
+    token: AmazonToken
+    loaded: bool
+    version: int
+
+    def __init__(self):
+        self.token = None
+        self.loaded = False
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def get(self) -> AmazonToken:
+        with self.lock:
+            if not self.loaded:
+                self.token = read_token_file()
+                self.loaded = True
+
+            return self.token
+
+    def save(self, token: AmazonToken) -> None:
+        with self.lock:
+            write_token_file(token)
+
+            self.token = token
+            self.loaded = True
+            self.version += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            remove_token_file()
+
+            self.token = None
+            self.loaded = True
+            self.version += 1
+
+    def refresh(
+        self, url: AmazonURL, use_cookies: bool, margin: float = 0
+    ) -> AmazonToken:
+        with self.lock:
+            token = self.get()
+            if token is None:
+                return None
+
+            # Whoever waited for the lock finds a fresh token here
+            # and doesn't refresh it again
+            auth = AmazonAuth(token, url, use_cookies, self.save)
+            auth.refresh(margin)
+
+            return self.token
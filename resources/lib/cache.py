@@ -0,0 +1,213 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+from .utils import atomic_write
+
+
+class CacheEntry:
+    value: bytes
+    created: float
+    etag: str
+    last_modified: str
+    ttl: float
+
+    # Without a ttl, the entry uses the one of the cache
+    def __init__(
+        self,
+        value: bytes,
+        etag: str = None,
+        last_modified: str = None,
+        ttl: float = None,
+    ):
+        self.value = value
+        self.created = time.monotonic()
+        self.etag = etag
+        self.last_modified = last_modified
+        self.ttl = ttl
+
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        return headers
+
+
+class LRUCache:
+    max_size: int
+    ttl: float
+    size: int
+
+    hits: int
+    misses: int
+    revalidations: int
+    evictions: int
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns the entry for key and whether it is still fresh. Expired
+    # entries are returned too, so that their validators can be used
+    # for a conditional request.
+    def get(self, key: Hashable) -> Tuple[CacheEntry, bool]:
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            self.entries.move_to_end(key)
+
+            ttl = self.ttl if entry.ttl is None else entry.ttl
+            if entry.age() > ttl:
+                self.misses += 1
+                return entry, False
+
+            self.hits += 1
+            return entry, True
+
+    def put(self, key: Hashable, entry: CacheEntry) -> None:
+        size = len(entry.value)
+
+        # Never let a single entry flush the whole cache
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.value)
+
+            self.entries[key] = entry
+            self.size += size
+
+            while self.size > self.max_size:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old.value)
+                self.evictions += 1
+
+    def revalidate(self, key: Hashable) -> None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+
+            entry.created = time.monotonic()
+            self.revalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+            }
+
+
+# A size capped cache of files in a directory. The modification time of a
+# file is its last use, so the files that were not used for the longest
+# time are removed first. The directory survives restarts of the proxy.
+class DiskCache:
+    path: str
+    max_size: int
+
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def filename(self, key: str) -> str:
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.filename(key)
+
+        with self.lock:
+            try:
+                with open(path, "rb") as f:
+                    value = f.read()
+            except OSError:
+                self.misses += 1
+                return None
+
+            os.utime(path)
+            self.hits += 1
+
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        # Never let a single entry flush the whole cache
+        if len(value) > self.max_size:
+            return
+
+        path = self.filename(key)
+
+        with self.lock:
+            atomic_write(path, value)
+            self.evict()
+
+    def files(self) -> List[os.DirEntry]:
+        try:
+            with os.scandir(self.path) as it:
+                return [e for e in it if e.is_file() and not e.name.endswith(".tmp")]
+        except OSError:
+            return []
+
+    def evict(self) -> None:
+        files = self.files()
+        size = sum(e.stat().st_size for e in files)
+
+        for e in sorted(files, key=lambda e: e.stat().st_mtime):
+            if size <= self.max_size:
+                break
+
+            size -= e.stat().st_size
+            os.remove(e.path)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            files = self.files()
+
+            return {
+                "entries": len(files),
+                "size": sum(e.stat().st_size for e in files),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,327 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import *
+from urllib.parse import urlparse
+
+import requests
+
+from .api import get_cdn_session
+from .utils import atomic_write
+
+# The candidate CDNs of a playback are probed at the same time. A probe
+# downloads the first PROBE_SIZE bytes of the manifest. The ones that
+# did not deliver them within PROBE_BUDGET seconds count as slow, see
+# timed_out(). Only connection errors and server errors count as failed.
+PROBE_BUDGET = 0.75
+PROBE_SIZE = 32 * 1024
+
+# Scores are only probed again once they are this many seconds old,
+# so playing titles back to back doesn't probe every time
+PROBE_INTERVAL = 10 * 60
+
+# Weight of a new measurement in the moving averages
+EWMA_WEIGHT = 0.3
+
+# A CDN that failed is only used as a fallback for this many seconds,
+# doubled with every further failure
+UNHEALTHY_MIN = 60
+UNHEALTHY_MAX = 60 * 60
+
+# CDNs are compared by the time it would take them to deliver a
+# segment of this size, which weighs latency against throughput
+SEGMENT_SIZE = 2 * 1024 * 1024
+
+
+# One of the url sets of the playback resources
+class UrlSet:
+    id: str
+    cdn: str
+    url: str
+
+    def __init__(self, id: str, cdn: str, url: str):
+        self.id = id
+        self.cdn = cdn
+        self.url = url
+
+    def to_dict(self) -> Dict:
+        return {"id": self.id, "cdn": self.cdn, "url": self.url}
+
+    @staticmethod
+    def from_dict(data: Dict) -> "UrlSet":
+        return UrlSet(data["id"], data["cdn"], data["url"])
+
+
+class CDNScore:
+    latency: float
+    throughput: float
+    failures: int
+    failed: float
+    probed: float
+
+    def __init__(
+        self,
+        latency: float = None,
+        throughput: float = None,
+        failures: int = 0,
+        failed: float = None,
+        probed: float = None,
+    ):
+        self.latency = latency
+        self.throughput = throughput
+        self.failures = failures
+        self.failed = failed
+        self.probed = probed
+
+    def update(self, latency: float, throughput: float = None) -> None:
+        self.latency = ewma(self.latency, latency)
+
+        if throughput is not None:
+            self.throughput = ewma(self.throughput, throughput)
+
+        self.failures = 0
+        self.failed = None
+
+    def fail(self) -> None:
+        self.failures += 1
+        self.failed = time.time()
+
+    def healthy(self) -> bool:
+        if self.failed is None:
+            return True
+
+        delay = min(UNHEALTHY_MIN * 2 ** (self.failures - 1), UNHEALTHY_MAX)
+        return time.time() - self.failed > delay
+
+    # Expected time for a segment, CDNs without measurements come last
+    def cost(self) -> float:
+        if self.latency is None:
+            return float("inf")
+
+        if self.throughput is None or self.throughput <= 0:
+            return self.latency
+
+        return self.latency + SEGMENT_SIZE / self.throughput
+
+    def to_dict(self) -> Dict:
+        return {
+            "latency": self.latency,
+            "throughput": self.throughput,
+            "failures": self.failures,
+            "failed": self.failed,
+            "probed": self.probed,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict) -> "CDNScore":
+        return CDNScore(
+            data.get("latency"),
+            data.get("throughput"),
+            data.get("failures", 0),
+            data.get("failed"),
+            data.get("probed"),
+        )
+
+
+def ewma(average: Optional[float], value: float) -> float:
+    if average is None:
+        return value
+
+    return average + EWMA_WEIGHT * (value - average)
+
+
+# Returns the name of the CDN, or its host if Amazon didn't name it
+def cdn_name(manifest: Dict) -> str:
+    name = manifest.get("cdn")
+    if name:
+        return name
+
+    return urlparse(manifest["url"]).hostname
+
+
+# The measurement of a probe that ran out of time. The CDN answered
+# within the budget at best, and delivered PROBE_SIZE bytes in it at
+# best, so it scores worse than any CDN that made it in time.
+def timed_out(budget: float) -> Tuple[float, float]:
+    return budget, PROBE_SIZE / budget
+
+
+# Measures the time until the response headers arrived and the
+# throughput of the body. Returns None if the CDN failed, and no
+# latency if the response says nothing about the CDN.
+def probe_url(
+    url: str, budget: float
+) -> Optional[Tuple[Optional[float], Optional[float]]]:
+    headers = {"Range": "bytes=0-{}".format(PROBE_SIZE - 1)}
+
+    try:
+        resp = get_cdn_session().get(url, headers=headers, stream=True, timeout=budget)
+    except requests.Timeout:
+        return timed_out(budget)
+    except requests.RequestException:
+        return None
+
+    with resp:
+        if resp.status_code >= 500:
+            return None
+
+        # Other errors would be the same on every CDN
+        if resp.status_code not in (200, 206):
+            return None, None
+
+        latency = resp.elapsed.total_seconds()
+
+        size = 0
+        start = time.perf_counter()
+
+        try:
+            for chunk in resp.iter_content(chunk_size=PROBE_SIZE):
+                size += len(chunk)
+
+                # Servers that ignore the range send the whole manifest
+                if size >= PROBE_SIZE:
+                    break
+        except requests.Timeout:
+            pass
+        except requests.RequestException:
+            return None
+
+        elapsed = time.perf_counter() - start
+
+    if elapsed <= 0:
+        return latency, None
+
+    return latency, size / elapsed
+
+
+# Keeps a score for every CDN that served a manifest, in a file in the
+# addon profile, so that they survive restarts of Kodi. The proxy probes
+# the url sets of every new playback that has no recent scores, and
+# tries them in the order of rank() until one of them works.
+class CDNSelector:
+    path: str
+    scores: Dict[str, CDNScore]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.scores = {}
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError:
+            return
+
+        self.scores = {cdn: CDNScore.from_dict(s) for cdn, s in data.items()}
+
+    # Must be called with the lock held
+    def save(self) -> None:
+        data = {cdn: score.to_dict() for cdn, score in self.scores.items()}
+        atomic_write(self.path, json.dumps(data).encode())
+
+    def score(self, cdn: str) -> CDNScore:
+        score = self.scores.get(cdn)
+        if score is None:
+            score = self.scores[cdn] = CDNScore()
+
+        return score
+
+    def record(self, cdn: str, latency: float, throughput: float = None) -> None:
+        with self.lock:
+            self.score(cdn).update(latency, throughput)
+            self.save()
+
+    def fail(self, cdn: str) -> None:
+        with self.lock:
+            self.score(cdn).fail()
+            self.save()
+
+    def needs_probe(self, sets: List[UrlSet]) -> bool:
+        if len(set(s.cdn for s in sets)) < 2:
+            return False
+
+        now = time.time()
+
+        with self.lock:
+            for s in sets:
+                score = self.scores.get(s.cdn)
+                if score is None or score.probed is None:
+                    return True
+
+                if now - score.probed > PROBE_INTERVAL:
+                    return True
+
+        return False
+
+    # Probes every url set at the same time, but waits at most budget
+    # seconds for them. The requests that are still running finish in
+    # the background, their results are ignored. They count as slow
+    # instead of failed, so that a congested network doesn't mark every
+    # CDN unhealthy, and the ranking still follows the measurements.
+    def probe(self, sets: List[UrlSet], budget: float = PROBE_BUDGET) -> None:
+        pool = ThreadPoolExecutor(len(sets), "cdn")
+        futures = {pool.submit(probe_url, s.url, budget): s for s in sets}
+        pool.shutdown(wait=False)
+
+        done, _ = wait(futures, timeout=budget)
+        now = time.time()
+
+        with self.lock:
+            for future, s in futures.items():
+                score = self.score(s.cdn)
+                score.probed = now
+
+                if future in done:
+                    result = future.result()
+                else:
+                    result = timed_out(budget)
+
+                if result is None:
+                    score.fail()
+                elif result[0] is not None:
+                    score.update(*result)
+
+            self.save()
+
+    # Probes the url sets in the background, so that the session doesn't
+    # wait for it. The first manifest is fetched with the current ranking,
+    # later ones use the new scores. The sets are marked as probed right
+    # away, so that playbacks started in the meantime don't probe again.
+    def start_probe(self, sets: List[UrlSet], budget: float = PROBE_BUDGET) -> None:
+        now = time.time()
+
+        with self.lock:
+            for s in sets:
+                self.score(s.cdn).probed = now
+
+        thread = threading.Thread(
+            target=self.probe, args=(sets, budget), name="cdn-probe", daemon=True
+        )
+        thread.start()
+
+    # The healthy CDNs from the fastest to the slowest, followed by the
+    # ones that failed recently. The default set wins ties, because
+    # the sets are passed in with the default first.
+    def rank(self, sets: List[UrlSet]) -> List[UrlSet]:
+        with self.lock:
+            scores = [self.scores.get(s.cdn, CDNScore()) for s in sets]
+
+        order = sorted(
+            range(len(sets)),
+            key=lambda i: (not scores[i].healthy(), scores[i].cost(), i),
+        )
+
+        return [sets[i] for i in order]
+
+    def stats(self) -> Dict[str, Dict]:
+        with self.lock:
+            return {cdn: score.to_dict() for cdn, score in self.scores.items()}
@@ -0,0 +1,108 @@
+import time
+import zlib
+from typing import *
+
+# Manifests and subtitles are repetitive XML and text, the fastest level
+# already shrinks them to a fraction, higher levels mostly cost CPU time
+COMPRESSION_LEVEL = 1
+
+# Window bits of zlib for the content codings, in order of preference
+ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+# Returns the preferred content coding that the client accepts, if any
+def accepted_encoding(header: str) -> Optional[str]:
+    accepted = set()
+
+    for part in header.split(","):
+        name, *params = part.split(";")
+        q = 1.0
+
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        # gzip;q=0 means that gzip must not be used
+        if q > 0:
+            accepted.add(name.strip().lower())
+
+    for encoding in ENCODINGS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+
+    return None
+
+
+# Compresses a response as it is being produced, and keeps the number
+# of bytes in and out and the CPU time spent on the compression
+class Compressor:
+    encoding: str
+    size: int
+    compressed: int
+    cpu: float
+
+    def __init__(self, encoding: str, level: int = COMPRESSION_LEVEL):
+        self.encoding = encoding
+        self.size = 0
+        self.compressed = 0
+        self.cpu = 0.0
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+
+    def compress(self, data: bytes) -> bytes:
+        start = time.thread_time()
+        out = self.obj.compress(data)
+        self.cpu += time.thread_time() - start
+
+        self.size += len(data)
+        self.compressed += len(out)
+
+        return out
+
+    def flush(self) -> bytes:
+        start = time.thread_time()
+        out = self.obj.flush()
+        self.cpu += time.thread_time() - start
+
+        self.compressed += len(out)
+
+        return out
+
+    def ratio(self) -> Optional[float]:
+        if self.compressed == 0:
+            return None
+
+        return self.size / self.compressed
+
+    def __str__(self) -> str:
+        return "{}: {} -> {} bytes, ratio {:.1f}, {:.2f}ms CPU".format(
+            self.encoding,
+            self.size,
+            self.compressed,
+            self.ratio() or 0,
+            self.cpu * 1000,
+        )
+
+
+def compress_body(body: bytes, compressor: Compressor) -> bytes:
+    return compressor.compress(body) + compressor.flush()
+
+
+# Chunks that compress to nothing are held back, so that the client
+# never receives empty chunks
+def compress_chunks(
+    chunks: Iterable[bytes], compressor: Compressor, done: Callable[[], None]
+) -> Iterator[bytes]:
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if len(out) > 0:
+            yield out
+
+    yield compressor.flush()
+    done()
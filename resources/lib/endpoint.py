@@ -0,0 +1,151 @@
+import threading
+import time
+from typing import *
+from urllib.parse import urlencode
+
+import xbmc
+
+from .api import AmazonToken, AmazonURL, get_session
+from .utils import *
+
+# The region config rarely changes, so a cached copy is used as is for
+# ENDPOINT_TTL seconds and refreshed in the background afterwards.
+# Entries older than ENDPOINT_MAX_AGE are refreshed before they are used.
+ENDPOINT_TTL = 24 * 60 * 60
+ENDPOINT_MAX_AGE = 7 * 24 * 60 * 60
+
+# The endpoints that this process resolved or loaded, by account, with the
+# time they were resolved at. The service looks the endpoint up for every
+# playback, see proxy.post_session, and doesn't read the file every time.
+resolved: Dict[str, Tuple[AmazonURL, str, float]] = {}
+resolved_lock = threading.Lock()
+
+
+def base_request(data) -> Dict[str, str]:
+    base = {
+        "deviceID": device_id(),
+        "deviceTypeId": device_type(),
+        "format": "json",
+        "version": "1",
+        "firmware": "1",
+    }
+
+    base.update(data)
+    return base
+
+
+def playback_request(data) -> Dict[str, str]:
+    settings = get_settings()
+
+    base = {
+        "audioTrackId": "all",
+        "consumptionType": "Streaming",
+        "deviceBitrateAdaptationsOverride": "CVBR,CBR",
+        "deviceDrmOverride": "CENC",
+        "deviceHdrFormatsOverride": ",".join(settings.hdr),
+        "deviceProtocolOverride": "Https",
+        "deviceStreamingTechnologyOverride": "DASH",
+        "deviceVideoCodecOverride": ",".join(settings.codecs),
+        "deviceVideoQualityOverride": settings.resolution,
+        "languageFeature": "MLFv2",
+        "resourceUsage": "ImmediateConsumption",
+        "subtitleFormat": "TTMLv2",
+        "supportedDRMKeyScheme": "DUAL_KEY",
+    }
+
+    base.update(data)
+    return base_request(base)
+
+
+def fetch_endpoint() -> Tuple[AmazonURL, str]:
+    url = AmazonURL("amazon.com")
+
+    data = base_request({})
+    resp = get_session().get(url.config() + "?" + urlencode(data))
+    if resp.status_code != 200:
+        raise Exception("Failed to get region config")
+
+    data = resp.json()
+
+    host = data["territoryConfig"]["defaultVideoWebsite"]
+    host = host.lstrip("https://")
+    host = host.lstrip("www.")
+
+    region = data["customerConfig"]["homeRegion"].lower()
+    region = "" if "na" in region else "-" + region
+
+    api = "atv-ps{}.{}".format(region, host)
+    marketplace = data["customerConfig"]["marketplaceId"]
+
+    return AmazonURL(host, api), marketplace
+
+
+def refresh_endpoint(key: str) -> Tuple[AmazonURL, str]:
+    url, marketplace = fetch_endpoint()
+    save_endpoint(key, url, marketplace)
+
+    with resolved_lock:
+        resolved[key] = (url, marketplace, time.time())
+
+    return url, marketplace
+
+
+def cached_endpoint(key: str) -> Optional[Tuple[AmazonURL, str, float]]:
+    with resolved_lock:
+        entry = resolved.get(key)
+
+    if entry is None:
+        cached = load_endpoint(key)
+        if cached is None:
+            return None
+
+        url, marketplace, age = cached
+        entry = (url, marketplace, time.time() - age)
+
+        with resolved_lock:
+            resolved[key] = entry
+
+    url, marketplace, created = entry
+    return url, marketplace, time.time() - created
+
+
+def refresh_endpoint_background(key: str) -> None:
+    try:
+        refresh_endpoint(key)
+    except Exception as e:
+        log("Background endpoint refresh failed: {}".format(e), xbmc.LOGWARNING)
+
+
+def get_endpoint(token: AmazonToken) -> Tuple[AmazonURL, str]:
+    key = account_key(token)
+
+    cached = cached_endpoint(key)
+    if cached is None:
+        return refresh_endpoint(key)
+
+    url, marketplace, age = cached
+    if age > ENDPOINT_MAX_AGE:
+        return refresh_endpoint(key)
+
+    # Stale, but still usable. Don't block playback on the refresh.
+    if age > ENDPOINT_TTL:
+        thread = threading.Thread(target=refresh_endpoint_background, args=(key,))
+        thread.start()
+
+    return url, marketplace
+
+
+def license_url(asin: str, endpoint: Tuple[AmazonURL, str]) -> str:
+    url, marketplace = endpoint
+
+    # Prepare the widevine license URL
+    data = playback_request(
+        {
+            "asin": asin,
+            "marketplaceID": marketplace,
+            "desiredResources": "Widevine2License",
+            "videoMaterialType": "Feature",
+        }
+    )
+
+    return url.playback() + "?" + urlencode(data)
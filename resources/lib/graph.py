@@ -0,0 +1,83 @@
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import *
+
+from .profiling import profile_call
+
+
+class TaskResult:
+    name: str
+    start: float
+    time: float
+
+    def __init__(self, name: str, start: float, time: float):
+        self.name = name
+        self.start = start
+        self.time = time
+
+    def __str__(self) -> str:
+        return "{}: {:.2f}ms (started after {:.2f}ms)".format(
+            self.name, self.time * 1000, self.start * 1000
+        )
+
+
+class Task:
+    name: str
+    func: Callable[..., Any]
+    deps: List[str]
+
+    def __init__(self, name: str, func: Callable[..., Any], deps: List[str]):
+        self.name = name
+        self.func = func
+        self.deps = deps
+
+
+# A set of tasks that depend on the results of other tasks. Every task
+# is called with the results of its dependencies as arguments, and runs
+# as soon as they are available, in parallel to all unrelated tasks.
+class TaskGraph:
+    tasks: Dict[str, Task]
+    results: List[TaskResult]
+
+    def __init__(self):
+        self.tasks = {}
+        self.results = []
+
+    def add(self, name: str, func: Callable[..., Any], *deps: str) -> None:
+        for dep in deps:
+            if dep not in self.tasks:
+                raise Exception("Unknown dependency of {}: {}".format(name, dep))
+
+        self.tasks[name] = Task(name, func, list(deps))
+
+    def run(self) -> Dict[str, Any]:
+        futures = {}
+        begin = time.perf_counter()
+
+        def call(task: Task) -> Any:
+            args = [futures[dep].result() for dep in task.deps]
+
+            start = time.perf_counter()
+            value = profile_call(task.func, *args)
+            end = time.perf_counter()
+
+            self.results.append(TaskResult(task.name, start - begin, end - start))
+            return value
+
+        # Tasks can only depend on tasks that were added before them, and
+        # every task has its own thread, so waiting on a dependency can't
+        # block a task that has not started yet
+        with ThreadPoolExecutor(len(self.tasks), "graph") as pool:
+            for task in self.tasks.values():
+                futures[task.name] = pool.submit(call, task)
+
+            done, _ = wait(futures.values(), return_when=FIRST_EXCEPTION)
+
+            for future in done:
+                if future.exception() is not None:
+                    for f in futures.values():
+                        f.cancel()
+
+                    raise future.exception()
+
+        return {name: future.result() for name, future in futures.items()}
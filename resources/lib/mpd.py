@@ -1,18 +1,51 @@
 import copy
 import posixpath
+import time
 from typing import *
+from urllib.parse import urlencode
 from xml.etree import ElementTree
 
-import requests
-
-from .api import HEADERS
-from .utils import *
+from .pipeline import Pipeline, Stage, StageResult
 
 NAMESPACES = {
     "cenc": "urn:mpeg:cenc:2013",
     "dash": "urn:mpeg:dash:schema:mpd:2011",
 }
 
+ADAPTATION_SET = "{urn:mpeg:dash:schema:mpd:2011}AdaptationSet"
+BASE_URL = "{urn:mpeg:dash:schema:mpd:2011}BaseURL"
+REPRESENTATION = "{urn:mpeg:dash:schema:mpd:2011}Representation"
+ROLE = "{urn:mpeg:dash:schema:mpd:2011}Role"
+SEGMENT_TEMPLATE = "{urn:mpeg:dash:schema:mpd:2011}SegmentTemplate"
+SUPPLEMENTAL_PROPERTY = "{urn:mpeg:dash:schema:mpd:2011}SupplementalProperty"
+
+
+class PatchOptions:
+    url: str
+    subs: List[Dict]
+    forced: List[Dict]
+    prefer_atmos: bool
+    skip: Set[str]
+    subtitle_proxy: str
+    results: List[StageResult]
+
+    def __init__(
+        self,
+        url: str,
+        subs: List[Dict],
+        forced: List[Dict],
+        prefer_atmos: bool,
+        skip: Set[str] = None,
+        subtitle_proxy: str = None,
+    ):
+        self.url = url
+        self.subs = subs
+        self.forced = forced
+        self.prefer_atmos = prefer_atmos
+        self.skip = set() if skip is None else skip
+        self.subtitle_proxy = subtitle_proxy
+        self.results = []
+
 
 def find(tree: ElementTree.Element, xpath: str) -> List[ElementTree.Element]:
     return tree.find(xpath, namespaces=NAMESPACES)
@@ -22,38 +55,61 @@ def findall(tree: ElementTree.Element, xpath: str) -> List[ElementTree.Element]:
     return tree.findall(xpath, namespaces=NAMESPACES)
 
 
-def patch_full_url(tree: ElementTree.Element, url: str) -> None:
+def patch_full_url(tree: ElementTree.Element, url: str) -> int:
     base_url = posixpath.dirname(url)
+    count = 0
+
+    # One walk over the tree instead of one search per element type
+    for elem in tree.iter():
+        if elem.tag == BASE_URL:
+            elem.text = base_url + "/" + elem.text
+            count += 1
+
+        elif elem.tag == SEGMENT_TEMPLATE:
+            for attr in ["media", "initialization"]:
+                value = elem.get(attr)
+                if value is None:
+                    continue
 
-    for elem in findall(tree, ".//dash:BaseURL"):
-        elem.text = base_url + "/" + elem.text
-
-    for elem in findall(tree, ".//dash:SegmentTemplate[@media]"):
-        elem.set("media", base_url + "/" + elem.get("media"))
+                elem.set(attr, base_url + "/" + value)
+                count += 1
 
-    for elem in findall(tree, ".//dash:SegmentTemplate[@initialization]"):
-        elem.set("initialization", base_url + "/" + elem.get("initialization"))
+    return count
 
 
-def split_adaptation_sets(tree: ElementTree.Element) -> None:
+def split_adaptation_sets(tree: ElementTree.Element) -> int:
     adsets = findall(tree, "./dash:AdaptationSet")
+    count = 0
 
     for adset in adsets:
         if adset.get("contentType") != "audio":
             continue
 
-        reps = findall(adset, "./dash:Representation")
+        # Split the children into the representations and the rest of the
+        # adaptation set, and remember where each representation was placed
+        shell = []
+        reps = []
 
-        # Create a copy of the adaptation set for every representation
-        for i in range(0, len(reps)):
-            cp_adset = copy.deepcopy(adset)
-            cp_reps = findall(cp_adset, "./dash:Representation")
+        for child in adset:
+            if child.tag == REPRESENTATION:
+                reps.append((child, len(shell)))
+            else:
+                shell.append(child)
 
-            for j in range(0, len(reps)):
-                if i == j:
-                    continue
+        # Create a copy of the adaptation set for every representation.
+        # Only the shell is copied, the representation itself is moved.
+        for rep, pos in reps:
+            cp_adset = ElementTree.Element(adset.tag, adset.attrib)
+            cp_adset.text = adset.text
+            cp_adset.tail = adset.tail
+
+            for child in shell[:pos]:
+                cp_adset.append(copy.deepcopy(child))
 
-                cp_adset.remove(cp_reps[j])
+            cp_adset.append(rep)
+
+            for child in shell[pos:]:
+                cp_adset.append(copy.deepcopy(child))
 
             if "minBandwidth" in cp_adset.attrib:
                 del cp_adset.attrib["minBandwidth"]
@@ -63,66 +119,161 @@ def split_adaptation_sets(tree: ElementTree.Element) -> None:
 
             # Add the new adaptation set...
             tree.append(cp_adset)
+            count += 1
 
         # and remove the old one once all its
-        # representations have been cloned
+        # representations have been moved
         tree.remove(adset)
 
+    return count
+
+
+class Representation:
+    __slots__ = ["id", "bandwidth", "codecs", "atmos"]
+
+    id: str
+    bandwidth: int
+    codecs: str
+    atmos: bool
+
+    def __init__(self, id: str, bandwidth: int, codecs: str, atmos: bool):
+        self.id = id
+        self.bandwidth = bandwidth
+        self.codecs = codecs
+        self.atmos = atmos
+
+
+# What the track selection needs to know about an adaptation set. All of
+# it is read from the tree in one pass, so that ranking the tracks is a
+# comparison of plain values instead of a search for every comparison.
+class AdaptationSet:
+    __slots__ = [
+        "elem",
+        "content_type",
+        "lang",
+        "track_id",
+        "atmos",
+        "role",
+        "representations",
+    ]
+
+    elem: ElementTree.Element
+    content_type: str
+    lang: str
+    track_id: str
+    atmos: bool
+    role: Optional[ElementTree.Element]
+    representations: List[Representation]
+
+    def __init__(
+        self,
+        elem: ElementTree.Element,
+        atmos: bool,
+        role: Optional[ElementTree.Element],
+        representations: List[Representation],
+    ):
+        self.elem = elem
+        self.content_type = elem.get("contentType")
+        self.lang = elem.get("lang")
+        self.track_id = elem.get("audioTrackId")
+        self.atmos = atmos
+        self.role = role
+        self.representations = representations
+
+    # Audio adaptation sets only have one representation once they are split
+    @property
+    def bandwidth(self) -> int:
+        if len(self.representations) == 0:
+            return 0
+
+        return self.representations[0].bandwidth
+
+
+def is_atmos(elem: ElementTree.Element) -> bool:
+    for e in elem.iter(SUPPLEMENTAL_PROPERTY):
+        if e.get("value") == "JOC":
+            return True
+
+    return False
+
+
+def index_adaptation_sets(tree: ElementTree.Element) -> List[AdaptationSet]:
+    adsets = []
+
+    for elem in tree:
+        if elem.tag != ADAPTATION_SET:
+            continue
 
-# Is A a better audio track than B?
-def is_higher_quality(a: ElementTree.Element, b: ElementTree.Element) -> bool:
-    atmos_a = len(findall(a, ".//dash:SupplementalProperty[@value='JOC']")) > 0
-    atmos_b = len(findall(b, ".//dash:SupplementalProperty[@value='JOC']")) > 0
+        atmos = False
+        role = None
+        reps = []
 
-    if atmos_a != atmos_b and prefer_atmos():
-        return atmos_a
+        for child in elem:
+            if child.tag == REPRESENTATION:
+                rep = Representation(
+                    child.get("id"),
+                    int(child.get("bandwidth", 0)),
+                    child.get("codecs"),
+                    is_atmos(child),
+                )
 
-    bitrate_a = int(find(a, "./dash:Representation").get("bandwidth"))
-    bitrate_b = int(find(b, "./dash:Representation").get("bandwidth"))
+                reps.append(rep)
+                atmos = atmos or rep.atmos
 
-    return bitrate_a > bitrate_b
+            elif child.tag == ROLE and role is None:
+                role = child
 
+            elif not atmos:
+                atmos = is_atmos(child)
 
-def patch_audio_metadata(tree: ElementTree.Element) -> None:
-    adsets = findall(tree, "./dash:AdaptationSet")
+        adsets.append(AdaptationSet(elem, atmos, role, reps))
 
-    found = {}
+    return adsets
 
-    for adset in adsets:
-        if adset.get("contentType") != "audio":
+
+# Audio tracks with a higher key are better. Atmos wins over a higher
+# bitrate, if it is preferred.
+def quality(adset: AdaptationSet, prefer_atmos: bool) -> Tuple[bool, int]:
+    return adset.atmos and prefer_atmos, adset.bandwidth
+
+
+def patch_audio_metadata(tree: ElementTree.Element, prefer_atmos: bool) -> int:
+    tracks = {}
+    count = 0
+
+    for adset in index_adaptation_sets(tree):
+        if adset.content_type != "audio":
             continue
 
-        track_id = adset.get("audioTrackId")
+        track_id = adset.track_id
         if track_id is None:
             track_id = "audio"
 
-        # This is the first track we found for that track id
-        if track_id not in found:
-            adset.set("default", "true")
-            found[track_id] = adset
+        tracks.setdefault(track_id, []).append(adset)
+
+    for track_id, adsets in tracks.items():
+        # The first of the best adaptation sets becomes the default
+        best = max(adsets, key=lambda adset: quality(adset, prefer_atmos))
 
-        # We already found a track for this id, but this track is better
-        elif is_higher_quality(adset, found[track_id]):
-            adset.set("default", "true")
-            found[track_id].set("default", "false")
-            found[track_id] = adset
+        for adset in adsets:
+            elem = adset.elem
+            elem.set("default", "true" if adset is best else "false")
 
-        # This track is not better than what we already found
-        else:
-            adset.set("default", "false")
+            # Remove the Role tag, because it overrides the default value
+            if adset.role is not None:
+                elem.remove(adset.role)
 
-        # Remove the Role tag, because it overrides the default value
-        adset.remove(find(adset, "./dash:Role"))
+            # Set flag for audio descriptions
+            if "descriptive" in track_id:
+                elem.set("impaired", "true")
+            else:
+                elem.set("impaired", "false")
 
-        # Set flag for audio descriptions
-        if "descriptive" in track_id:
-            adset.set("impaired", "true")
-        else:
-            adset.set("impaired", "false")
+            # Use the name property to show the bitrate in Kodi
+            elem.set("name", "{:3d} kbps".format(adset.bandwidth // 1000))
+            count += 1
 
-        # Use the name property to show the bitrate in Kodi
-        bitrate = int(find(adset, "./dash:Representation").get("bandwidth"))
-        adset.set("name", "{:3d} kbps".format(bitrate // 1000))
+    return count
 
 
 def fix_locale(loc: str) -> str:
@@ -140,12 +291,24 @@ def fix_locale(loc: str) -> str:
     return l.split("-")[0]
 
 
-def add_subtitle(tree: ElementTree.Element, sub, forced) -> None:
+# Without a proxy, IS.A downloads the TTML files from Amazon directly.
+# With one, the tracks are converted to WebVTT and cached by the proxy.
+# The proxy URL already identifies the session, which knows the URL of
+# every track, so only the track ID is added to it.
+def add_subtitle(
+    tree: ElementTree.Element, sub, forced, proxy: str = None
+) -> None:
+    if proxy is None:
+        codecs, mime_type, url = "ttml", "application/ttml+xml", sub["url"]
+    else:
+        codecs, mime_type = "wvtt", "text/vtt"
+        url = proxy + "&" + urlencode({"track": sub["timedTextTrackId"]})
+
     adset = ElementTree.SubElement(tree, "dash:AdaptationSet", {
         "lang": fix_locale(sub["languageCode"]),
         "forced": "true" if forced else "false",
-        "codecs": "ttml",
-        "mimeType": "application/ttml+xml",
+        "codecs": codecs,
+        "mimeType": mime_type,
     })
 
     role = ElementTree.SubElement(adset, "dash:Role", {
@@ -158,42 +321,347 @@ def add_subtitle(tree: ElementTree.Element, sub, forced) -> None:
     })
 
     base_url = ElementTree.SubElement(rep, "dash:BaseURL")
-    base_url.text = sub["url"]
+    base_url.text = url
 
 
-def add_subtitles(tree: ElementTree.Element, subs, forced) -> None:
+def add_subtitles(
+    tree: ElementTree.Element, subs, forced, proxy: str = None
+) -> int:
     for sub in forced:
-        add_subtitle(tree, sub, True)
+        add_subtitle(tree, sub, True, proxy)
 
     for sub in subs:
-        add_subtitle(tree, sub, False)
-
-
-def patch_mpd(url: str, manifest: str, subs, forced) -> str:
+        add_subtitle(tree, sub, False, proxy)
+
+    return len(forced) + len(subs)
+
+
+PIPELINE = Pipeline(
+    [
+        # Replace relative URLs with absolute ones. Required because of the proxy
+        Stage("patch_full_url", lambda p, o: patch_full_url(p, o.url)),
+        # Split up adaptation sets with multiple representations, so that IS.A exposes
+        # all available streams to Kodi. Otherwise it will just choose the first one.
+        Stage("split_adaptation_sets", lambda p, o: split_adaptation_sets(p)),
+        # Patch audio metadata, to set default streams
+        Stage(
+            "patch_audio_metadata",
+            lambda p, o: patch_audio_metadata(p, o.prefer_atmos),
+        ),
+        Stage(
+            "add_subtitles",
+            lambda p, o: add_subtitles(p, o.subs, o.forced, o.subtitle_proxy),
+        ),
+    ]
+)
+
+
+def patch_period(
+    parent: ElementTree.Element, options: PatchOptions, pipeline: Pipeline
+) -> None:
+    options.results += pipeline.run(parent, options, options.skip)
+
+
+def register_namespaces() -> None:
     for namespace in NAMESPACES:
         ElementTree.register_namespace(namespace, NAMESPACES[namespace])
 
+
+def patch_mpd(
+    manifest: str, options: PatchOptions, pipeline: Pipeline = PIPELINE
+) -> str:
+    register_namespaces()
+
     tree = ElementTree.fromstring(manifest)
 
-    parent = find(tree, "./*[dash:AdaptationSet]")
+    # Every period has its own set of tracks, which
+    # are patched independently from each other
+    for parent in findall(tree, "./*[dash:AdaptationSet]"):
+        patch_period(parent, options, pipeline)
+
+    start = time.perf_counter()
+    txt = ElementTree.tostring(tree, encoding="unicode")
+    serialized = time.perf_counter()
 
-    # Replace relative URLs with absolute ones. Required because of the proxy
-    patch_full_url(parent, url)
+    # The dash: namespace confuses IS.A, so patch it out
+    txt = strip_dash_prefix(txt)
 
-    # Split up adaptation sets with multiple representations, so that IS.A exposes
-    # all available streams to Kodi. Otherwise it will just choose the first one.
-    split_adaptation_sets(parent)
+    elements = sum(1 for _ in tree.iter())
+    results = [
+        StageResult("serialize", serialized - start, elements),
+        StageResult("strip_namespaces", time.perf_counter() - serialized, elements),
+    ]
 
-    # Patch audio metadata, to set default streams
-    patch_audio_metadata(parent)
+    pipeline.record(results)
+    options.results += results
 
-    add_subtitles(parent, subs, forced)
+    return txt
 
-    txt = ElementTree.tostring(tree, encoding="unicode")
 
-    # The dash: namespace confuses IS.A, so patch it out
+# Prefixes that ElementTree picks for well known namespaces. Anything
+# else ends up as ns0, ns1, ... in the order it is first seen.
+KNOWN_PREFIXES = {
+    "http://www.w3.org/XML/1998/namespace": "xml",
+    "http://www.w3.org/1999/xhtml": "html",
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#": "rdf",
+    "http://schemas.xmlsoap.org/wsdl/": "wsdl",
+    "http://www.w3.org/2001/XMLSchema": "xs",
+    "http://www.w3.org/2001/XMLSchema-instance": "xsi",
+    "http://purl.org/dc/elements/1.1/": "dc",
+}
+KNOWN_PREFIXES.update({v: k for k, v in NAMESPACES.items()})
+
+
+def escape_text(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escape_attrib(text: str) -> str:
+    text = escape_text(text).replace('"', "&quot;")
+    text = text.replace("\r", "&#13;").replace("\n", "&#10;")
+    return text.replace("\t", "&#09;")
+
+
+def strip_dash_prefix(txt: str) -> str:
     txt = txt.replace("xmlns:dash", "xmlns")
     txt = txt.replace("<dash:", "<")
-    txt = txt.replace("</dash:", "</")
+    return txt.replace("</dash:", "</")
+
+
+# Serializes the manifest like ElementTree.tostring() does for the whole
+# tree, one child of the root at a time. ElementTree numbers unknown
+# namespaces ns0, ns1, ... in the order they are first used in the
+# document, and declares all of them on the root. The writer keeps one
+# prefix map for the whole document, and assigns the prefixes in the same
+# order. The root is written once the children that were parsed so far
+# have been scanned, so its declarations are the same as with
+# ElementTree. Only namespaces that are first used in later children are
+# declared on the children that use them instead of the root.
+class MPDWriter:
+    namespaces: Dict[str, str]
+    qnames: Dict[str, Tuple[str, Optional[str]]]
+    declared: Set[str]
+
+    def __init__(self):
+        self.namespaces = {}
+        self.qnames = {}
+        self.declared = set()
+
+    # Returns the qualified name and the namespace of a tag or attribute
+    def qname(self, name: str) -> Tuple[str, Optional[str]]:
+        qname = self.qnames.get(name)
+        if qname is not None:
+            return qname
+
+        if name[:1] != "{":
+            qname = self.qnames[name] = (name, None)
+            return qname
 
-    return txt
+        uri, local = name[1:].rsplit("}", 1)
+
+        prefix = self.namespaces.get(uri)
+        if prefix is None:
+            prefix = KNOWN_PREFIXES.get(uri)
+            if prefix is None:
+                prefix = "ns%d" % len(self.namespaces)
+
+            # The xml namespace is never declared
+            if prefix != "xml":
+                self.namespaces[uri] = prefix
+
+        qname = (prefix + ":" + local, None if prefix == "xml" else uri)
+        self.qnames[name] = qname
+
+        return qname
+
+    # Assigns prefixes to the namespaces of an element in document
+    # order, and returns the namespaces that it uses
+    def scan(self, elem: ElementTree.Element) -> Set[str]:
+        uris = set()
+
+        for e in elem.iter():
+            uris.add(self.qname(e.tag)[1])
+
+            for key in e.keys():
+                uris.add(self.qname(key)[1])
+
+        uris.discard(None)
+        return uris
+
+    def declarations(self, uris: Iterable[str]) -> str:
+        prefixes = sorted((self.namespaces[uri], uri) for uri in uris)
+
+        return "".join(
+            ' xmlns:{}="{}"'.format(prefix, escape_attrib(uri))
+            for prefix, uri in prefixes
+        )
+
+    # Returns the start tag of the root without the closing ">", which
+    # depends on whether the root has any content
+    def root_start(
+        self, root: ElementTree.Element, children: List[ElementTree.Element]
+    ) -> str:
+        # The parser might have read ahead, so the children that are still
+        # attached to the root are not scanned yet
+        uris = {self.qname(root.tag)[1]}
+        uris.update(self.qname(k)[1] for k in root.keys())
+        uris.discard(None)
+
+        for child in children:
+            uris |= self.scan(child)
+
+        self.declared = uris
+
+        parts = ["<", self.qname(root.tag)[0], self.declarations(uris)]
+        for k, v in root.items():
+            parts.append(' {}="{}"'.format(self.qname(k)[0], escape_attrib(v)))
+
+        return strip_dash_prefix("".join(parts))
+
+    def root_end(self, root: ElementTree.Element) -> str:
+        return strip_dash_prefix("</" + self.qname(root.tag)[0] + ">")
+
+    # The tail is written separately, because it is not known yet
+    # when the element is complete
+    def write(self, elem: ElementTree.Element) -> str:
+        uris = self.scan(elem) - self.declared
+
+        parts = []
+        self.serialize(elem, parts.append, self.declarations(uris))
+
+        return strip_dash_prefix("".join(parts))
+
+    def serialize(
+        self, elem: ElementTree.Element, write: Callable[[str], Any], ns: str = ""
+    ) -> None:
+        tag = self.qnames[elem.tag][0]
+
+        write("<" + tag + ns)
+        for k, v in elem.items():
+            write(' {}="{}"'.format(self.qnames[k][0], escape_attrib(v)))
+
+        text = elem.text
+        if not text and len(elem) == 0:
+            write(" />")
+            return
+
+        write(">")
+        if text:
+            write(escape_text(text))
+
+        for child in elem:
+            self.serialize(child, write)
+
+            if child.tail:
+                write(escape_text(child.tail))
+
+        write("</" + tag + ">")
+
+
+def parse_events(chunks: Iterable[bytes]) -> Iterator[Tuple[str, Any]]:
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
+
+    parser.close()
+    yield from parser.read_events()
+
+
+# Streaming variant of patch_mpd(). The manifest is parsed incrementally
+# and every child of the root element (usually a Period) is patched,
+# written and dropped as soon as it has been parsed completely. Only one
+# Period is held in memory at a time, and the output is produced in
+# chunks instead of one big string.
+#
+# The start tag of the root is written together with the first patched
+# Period, because its namespace declarations depend on what the Period
+# uses, see MPDWriter. A manifest that can't be parsed up to there fails
+# before anything was written.
+def stream_mpd(
+    chunks: Iterable[bytes], options: PatchOptions, pipeline: Pipeline = PIPELINE
+) -> Iterator[str]:
+    register_namespaces()
+
+    writer = MPDWriter()
+
+    root = None
+    pending = []
+    last = None
+    depth = 0
+    opened = False
+
+    def serialize(elem: ElementTree.Element) -> str:
+        start = time.perf_counter()
+
+        txt = writer.write(elem)
+        elements = sum(1 for _ in elem.iter())
+
+        result = StageResult("serialize", time.perf_counter() - start, elements)
+        pipeline.record([result])
+        options.results.append(result)
+
+        return txt
+
+    # Writes the root with the text before its first child, and the
+    # children that were parsed so far
+    def open_root() -> str:
+        parts = [writer.root_start(root, pending), ">"]
+        if root.text:
+            parts.append(escape_text(root.text))
+
+        for i, child in enumerate(pending):
+            if i > 0 and pending[i - 1].tail:
+                parts.append(escape_text(pending[i - 1].tail))
+
+            parts.append(serialize(child))
+
+        pending.clear()
+        return "".join(parts)
+
+    for event, elem in parse_events(chunks):
+        if event == "start":
+            depth += 1
+
+            if depth == 1:
+                root = elem
+
+            # The tail of an element is only known once the next one starts
+            elif depth == 2 and opened and last is not None and last.tail:
+                yield escape_text(last.tail)
+
+            continue
+
+        depth -= 1
+
+        if depth == 1:
+            root.remove(elem)
+            last = elem
+
+            period = find(elem, "./dash:AdaptationSet") is not None
+            if period:
+                patch_period(elem, options, pipeline)
+
+            if opened:
+                yield serialize(elem)
+                continue
+
+            pending.append(elem)
+
+            if period:
+                yield open_root()
+                opened = True
+
+        elif depth == 0:
+            if not opened and not pending and not root.text:
+                yield writer.root_start(root, pending) + " />"
+                continue
+
+            if not opened:
+                yield open_root()
+
+            if last is not None and last.tail:
+                yield escape_text(last.tail)
+
+            yield writer.root_end(root)
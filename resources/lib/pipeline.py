@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import *
+
+
+class StageResult:
+    name: str
+    time: float
+    elements: int
+
+    def __init__(self, name: str, time: float, elements: int):
+        self.name = name
+        self.time = time
+        self.elements = elements
+
+    def __str__(self) -> str:
+        return "{}: {:.2f}ms, {} elements".format(
+            self.name, self.time * 1000, self.elements
+        )
+
+
+class Stage:
+    name: str
+    func: Callable[[Any, Any], int]
+
+    def __init__(self, name: str, func: Callable[[Any, Any], int]):
+        self.name = name
+        self.func = func
+
+
+# An ordered list of stages that are applied to the same object. Every
+# stage returns the number of elements it touched, which is recorded
+# together with its wall time. The totals over all runs are kept, so
+# they can be inspected on long running processes like the proxy.
+class Pipeline:
+    stages: List[Stage]
+    totals: Dict[str, List[float]]
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def names(self) -> List[str]:
+        return [stage.name for stage in self.stages]
+
+    def run(
+        self, obj: Any, options: Any, skip: Container[str] = ()
+    ) -> List[StageResult]:
+        results = []
+
+        for stage in self.stages:
+            if stage.name in skip:
+                continue
+
+            start = time.perf_counter()
+            elements = stage.func(obj, options)
+            elapsed = time.perf_counter() - start
+
+            results.append(StageResult(stage.name, elapsed, elements))
+
+        self.record(results)
+        return results
+
+    # Also used for steps that are not part of the stage list,
+    # like serializing the result
+    def record(self, results: List[StageResult]) -> None:
+        with self.lock:
+            for result in results:
+                total = self.totals.setdefault(result.name, [0, 0.0, 0])
+                total[0] += 1
+                total[1] += result.time
+                total[2] += result.elements
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {
+                name: {
+                    "runs": runs,
+                    "time": total,
+                    "average": total / runs,
+                    "elements": elements,
+                }
+                for name, (runs, total, elements) in self.totals.items()
+            }
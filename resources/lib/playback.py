@@ -1,94 +1,132 @@
 import sys
-from base64 import urlsafe_b64encode
+import time
 from typing import *
-from urllib.parse import urlencode
+from urllib.parse import parse_qs, urlencode, urlparse
 
-import requests
+import xbmc
 import xbmcaddon
 import xbmcgui
 import xbmcplugin
 from inputstreamhelper import Helper
 
-from .api import DEVICE_NAME, HEADERS, AmazonAuth, AmazonURL
-from .auth import login
-from .proxy import HOST, PORT
+from .api import DEVICE_NAME, HEADERS, AmazonAuth, AmazonToken, AmazonURL, get_session
+from .cdn import UrlSet, cdn_name
+from .endpoint import get_endpoint, playback_request
+from .graph import TaskGraph
+from .profiling import profiled
 from .utils import *
 
+# The resources of a title are reused for as long as the URLs in them are
+# valid, minus a margin for the playback to start. URLs without a known
+# expiry are kept for RESOURCES_TTL seconds, see utils.
+RESOURCES_MAX_TTL = 60 * 60
+RESOURCES_MARGIN = 5 * 60
 
-def base_request(data) -> Dict[str, str]:
-    base = {
-        "deviceID": device_id(),
-        "deviceTypeId": device_type(),
-        "format": "json",
-        "version": "1",
-        "firmware": "1",
-    }
+# Query parameters that CDNs use for the expiry of signed URLs, as
+# Unix timestamps or as an exp= field of an Akamai token
+EXPIRY_PARAMS = ["Expires", "expires", "e"]
+TOKEN_PARAMS = ["hdnts", "hdntl", "__token__"]
 
-    base.update(data)
-    return base
-
-
-def playback_request(data) -> Dict[str, str]:
-    base = {
-        "audioTrackId": "all",
-        "consumptionType": "Streaming",
-        "deviceBitrateAdaptationsOverride": "CVBR,CBR",
-        "deviceDrmOverride": "CENC",
-        "deviceHdrFormatsOverride": ",".join(supported_hdr()),
-        "deviceProtocolOverride": "Https",
-        "deviceStreamingTechnologyOverride": "DASH",
-        "deviceVideoCodecOverride": ",".join(supported_codecs()),
-        "deviceVideoQualityOverride": supported_resolution(),
-        "languageFeature": "MLFv2",
-        "resourceUsage": "ImmediateConsumption",
-        "subtitleFormat": "TTMLv2",
-        "supportedDRMKeyScheme": "DUAL_KEY",
-    }
 
-    base.update(data)
-    return base_request(base)
+# If no token could be loaded, start the login process. It only runs
+# after IS.A was checked, so that the dialogs of inputstreamhelper and of
+# the login never show at the same time, and a missing IS.A is reported
+# before the user typed any credentials.
+def login_if_needed(token: Optional[AmazonToken], _) -> AmazonToken:
+    if token is None:
+        # Only imported here, because it is rarely needed
+        from .auth import login
 
+        token = login()
 
-def get_endpoint() -> AmazonURL:
-    url = AmazonURL("amazon.com")
+    return token
 
-    data = base_request({})
-    resp = requests.get(url.config() + "?" + urlencode(data), headers=HEADERS)
-    if resp.status_code != 200:
-        raise Exception("Failed to get region config")
 
-    data = resp.json()
+def check_inputstream() -> None:
+    ish = Helper("mpd", drm="com.widevine.alpha")
+    if not ish.check_inputstream():
+        raise Exception("Inputstream.Adaptive not active")
 
-    host = data["territoryConfig"]["defaultVideoWebsite"]
-    host = host.lstrip("https://")
-    host = host.lstrip("www.")
 
-    region = data["customerConfig"]["homeRegion"].lower()
-    region = "" if "na" in region else "-" + region
+def fresh_token(token: AmazonToken, endpoint: Tuple[AmazonURL, str]) -> AmazonToken:
+    url, _ = endpoint
 
-    api = "atv-ps{}.{}".format(region, host)
-    marketplace = data["customerConfig"]["marketplaceId"]
+    # Let the service refresh the token, so that parallel
+    # invocations don't all refresh it at the same time
+    fresh = refresh_token(url, is_browser())
+    if fresh is not None:
+        token = fresh
 
-    return AmazonURL(host, api), marketplace
+    return token
 
 
-def play(asin: str) -> None:
-    # If no token can be loaded, start the login process
-    token = load_token()
-    if token is None:
-        token = login()
+# Everything that changes the response of GetPlaybackResources
+def resources_key(asin: str, marketplace: str, token: AmazonToken) -> str:
+    settings = get_settings()
 
-    # Check if IS.A is available
-    ish = Helper("mpd", drm="com.widevine.alpha")
-    if not ish.check_inputstream():
-        raise Exception("Inputstream.Adaptive not active")
+    return "|".join(
+        [
+            asin,
+            marketplace,
+            account_key(token),
+            settings.device_type,
+            ",".join(settings.hdr),
+            ",".join(settings.codecs),
+            settings.resolution,
+        ]
+    )
 
-    url, marketplace = get_endpoint()
-    auth = AmazonAuth(token, url, is_browser(), save_token)
 
-    session = requests.Session()
-    session.auth = auth
-    session.headers.update(HEADERS)
+def url_expiry(url: str) -> Optional[float]:
+    query = parse_qs(urlparse(url).query)
+
+    for param in EXPIRY_PARAMS:
+        for value in query.get(param, []):
+            if value.isdigit():
+                return float(value)
+
+    for param in TOKEN_PARAMS:
+        for value in query.get(param, []):
+            for field in value.split("~"):
+                name, _, value = field.partition("=")
+                if name == "exp" and value.isdigit():
+                    return float(value)
+
+    return None
+
+
+def resources_ttl(resources: Dict) -> float:
+    urls = []
+
+    for host in resources["playbackUrls"]["urlSets"].values():
+        urls.append(host["urls"]["manifest"]["url"])
+
+    for sub in resources["subtitleUrls"] + resources["forcedNarratives"]:
+        urls.append(sub["url"])
+
+    expiries = [e for e in map(url_expiry, urls) if e is not None]
+    if len(expiries) == 0:
+        return RESOURCES_TTL
+
+    ttl = min(expiries) - time.time() - RESOURCES_MARGIN
+    return min(ttl, RESOURCES_MAX_TTL)
+
+
+def playback_resources(
+    asin: str, token: AmazonToken, endpoint: Tuple[AmazonURL, str]
+) -> Dict:
+    url, marketplace = endpoint
+
+    # Resuming a title, or Kodi retrying to resolve it, would get the
+    # same URLs again
+    key = resources_key(asin, marketplace, token)
+
+    resources = load_resources(key)
+    if resources is not None:
+        log("Playback resources cache hit: {}".format(asin), xbmc.LOGDEBUG)
+        return resources
+
+    auth = AmazonAuth(token, url, is_browser(), save_token)
 
     # Grab the MPD from Amazon
     data = playback_request(
@@ -100,7 +138,7 @@ def play(asin: str) -> None:
         }
     )
 
-    resp = session.get(url.playback() + "?" + urlencode(data))
+    resp = get_session().get(url.playback() + "?" + urlencode(data), auth=auth)
     if resp.status_code != 200:
         raise Exception("Failed to get playback resources")
 
@@ -117,48 +155,83 @@ def play(asin: str) -> None:
     if err is not None:
         raise Exception("{}: {}".format(err["errorCode"], err["message"]))
 
-    sets = data["playbackUrls"]["urlSets"]
-    host = sets[data["playbackUrls"]["defaultUrlSetId"]]
+    resources = {
+        "playbackUrls": data["playbackUrls"],
+        "subtitleUrls": data["subtitleUrls"],
+        "forcedNarratives": data["forcedNarratives"],
+    }
+
+    ttl = resources_ttl(resources)
+    if ttl > 0:
+        save_resources(key, resources, ttl)
+
+    return resources
+
+
+def register(asin: str, data: Dict) -> str:
+    hosts = data["playbackUrls"]["urlSets"]
+    default = data["playbackUrls"]["defaultUrlSetId"]
+    sets = []
+
+    # Every url set is the same manifest on a different CDN. The default
+    # comes first, so that it is used if the proxy knows nothing better.
+    for id in sorted(hosts, key=lambda id: id != default):
+        manifest = hosts[id]["urls"]["manifest"]
+
+        if manifest["drm"] != "CENC" or manifest["streamingTechnology"] != "DASH":
+            continue
 
-    manifest = host["urls"]["manifest"]["url"]
-    tech = host["urls"]["manifest"]["streamingTechnology"]
-    drm = host["urls"]["manifest"]["drm"]
+        sets.append(UrlSet(id, cdn_name(manifest), manifest["url"]).to_dict())
 
-    if drm != "CENC" or tech != "DASH":
+    if len(sets) == 0:
         raise Exception("Only MPEG-DASH with Widevine is supported")
 
-    # Proxy the MPD URL and apply some patches to the manifest
     subs = data["subtitleUrls"]
     forced = data["forcedNarratives"]
 
-    data = {
-        "url": urlsafe_b64encode(manifest.encode()).decode(),
-        "subs": urlsafe_b64encode(json.dumps(subs).encode()).decode(),
-        "forced": urlsafe_b64encode(json.dumps(forced).encode()).decode(),
-    }
-
-    manifest = "http://{}:{}/mpd?".format(HOST, PORT) + urlencode(data)
+    # The proxy keeps the manifest URLs and the subtitles, and builds the
+    # license URL itself. The proxied URLs only have the ID of the session.
+    return register_session(asin, sets, subs, forced)
 
-    ##
-    # TODO: Support subtitles
-    ##
 
-    # Prepare the widevine license URL
-    data = playback_request(
-        {
-            "asin": asin,
-            "marketplaceID": marketplace,
-            "desiredResources": "Widevine2License",
-            "videoMaterialType": "Feature",
-        }
+@profiled("play")
+def play(asin: str) -> None:
+    start = time.perf_counter()
+
+    # Steps that don't depend on each other run at the same time. Most of
+    # them wait for the network, so checking IS.A and looking up the
+    # endpoint overlap with the slow requests.
+    graph = TaskGraph()
+    graph.add("check_inputstream", check_inputstream)
+    graph.add("load_token", load_token)
+    graph.add("login", login_if_needed, "load_token", "check_inputstream")
+    graph.add("get_endpoint", get_endpoint, "login")
+    graph.add("refresh_token", fresh_token, "login", "get_endpoint")
+    graph.add(
+        "playback_resources",
+        lambda t, e: playback_resources(asin, t, e),
+        "refresh_token",
+        "get_endpoint",
+    )
+    graph.add(
+        "register_session", lambda r: register(asin, r), "playback_resources"
     )
 
-    lic = url.playback() + "?" + urlencode(data)
+    try:
+        id = graph.run()["register_session"]
+    finally:
+        for result in graph.results:
+            log("Play step {}".format(result), xbmc.LOGDEBUG)
+
+    # Proxy the MPD and license URLs. The proxy patches the manifest
+    # and adds fresh auth headers to the license requests.
+    proxy = "http://{}:{}".format(HOST, PORT)
+
+    manifest = proxy + "/mpd?" + urlencode({"session": id})
 
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    headers.update(HEADERS)
-    headers.update(session.auth.get_headers())
 
+    lic = proxy + "/license?" + urlencode({"session": id})
     lic += "|" + urlencode(headers)
     lic += "|widevine2Challenge=B{SSM}&includeHdcpTestKeyInLicense=true"
     lic += "|JBlicense;hdcpEnforcementResolutionPixels"
@@ -174,3 +247,6 @@ def play(asin: str) -> None:
     item.setProperty("inputstream.adaptive.stream_headers", urlencode(HEADERS))
 
     xbmcplugin.setResolvedUrl(int(sys.argv[1]), True, listitem=item)
+
+    elapsed = time.perf_counter() - start
+    log("Playback resolved in {:.2f}ms".format(elapsed * 1000), xbmc.LOGDEBUG)
@@ -0,0 +1,203 @@
+import cProfile
+import functools
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from typing import *
+
+import xbmc
+
+from .utils import get_settings, log, profile_path
+
+PROFILE_DIR = "profiles"
+EXTENSIONS = [".pstats", ".snapshot"]
+
+# cProfile and tracemalloc can't profile overlapping calls on different
+# threads, so calls that start while another one is profiled are not
+lock = threading.Lock()
+
+# The profile of the call that is being profiled, see profile_call()
+active = None
+
+
+def profile_name(name: str) -> str:
+    name = name.strip("/").replace("/", "_").replace("<", "").replace(">", "")
+    return name if len(name) > 0 else "root"
+
+
+# Keeps the newest files of every type. The names start
+# with the time they were written, so they sort by age.
+def rotate(path: str, keep: int) -> None:
+    for ext in EXTENSIONS:
+        files = sorted(f for f in os.listdir(path) if f.endswith(ext))
+
+        for name in files[: max(0, len(files) - keep)]:
+            os.remove(os.path.join(path, name))
+
+
+def save(
+    name: str,
+    stats: Optional[pstats.Stats],
+    snapshot: Optional[tracemalloc.Snapshot],
+) -> None:
+    settings = get_settings()
+
+    path = profile_path(PROFILE_DIR)
+    os.makedirs(path, exist_ok=True)
+
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    millis = int(time.time() * 1000) % 1000
+    base = os.path.join(path, "{}-{:03d}-{}".format(stamp, millis, profile_name(name)))
+
+    if stats is not None:
+        stats.dump_stats(base + ".pstats")
+
+    if snapshot is not None:
+        snapshot.dump(base + ".snapshot")
+
+    rotate(path, settings.profile_keep)
+    log("Profile written to {}".format(base), xbmc.LOGINFO)
+
+
+class Profile:
+    name: str
+    profiler: Optional[cProfile.Profile]
+    threads: List[cProfile.Profile]
+    memory: bool
+
+    def __init__(self, name: str, cpu: bool, memory: bool):
+        self.name = name
+        self.profiler = cProfile.Profile() if cpu else None
+        self.threads = []
+        self.threads_lock = threading.Lock()
+        self.memory = memory and not tracemalloc.is_tracing()
+
+        if self.memory:
+            tracemalloc.start()
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        if self.profiler is None:
+            return func(*args, **kwargs)
+
+        return self.profiler.runcall(func, *args, **kwargs)
+
+    # Adds the profile of work that ran on another thread
+    def add(self, profiler: cProfile.Profile) -> None:
+        with self.threads_lock:
+            self.threads.append(profiler)
+
+    def stats(self) -> Optional[pstats.Stats]:
+        if self.profiler is None:
+            return None
+
+        stats = pstats.Stats(self.profiler)
+
+        with self.threads_lock:
+            for profiler in self.threads:
+                stats.add(profiler)
+
+        return stats
+
+    def finish(self) -> None:
+        global active
+
+        active = None
+        snapshot = None
+
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        try:
+            save(self.name, self.stats(), snapshot)
+        except Exception as e:
+            log("Failed to write profile: {}".format(e), xbmc.LOGWARNING)
+        finally:
+            lock.release()
+
+
+# cProfile only sees the thread that it was enabled on. Work that a
+# profiled call hands to other threads, like the steps of play() in a
+# TaskGraph, runs through this, so that it ends up in the same profile.
+def profile_call(func: Callable, *args, **kwargs) -> Any:
+    profile = active
+    if profile is None or profile.profiler is None:
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+
+    # Since Python 3.12, only one profiler can be enabled at a time, and
+    # the one of the profiled call already sees all threads
+    try:
+        profiler.enable()
+    except ValueError:
+        return func(*args, **kwargs)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profile.add(profiler)
+
+
+# Keeps profiling a streamed response while it is being produced
+def profile_iter(it: Iterator, profile: Profile) -> Iterator:
+    try:
+        while True:
+            try:
+                chunk = profile.call(next, it)
+            except StopIteration:
+                return
+
+            yield chunk
+    finally:
+        profile.finish()
+
+
+# Runs func in cProfile and takes a tracemalloc snapshot at the end,
+# depending on the settings. Without profiling, the only overhead is
+# one look at the settings.
+def profiled(name: str) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            settings = get_settings()
+
+            if not settings.profile_cpu and not settings.profile_memory:
+                return func(*args, **kwargs)
+
+            if not lock.acquire(blocking=False):
+                return func(*args, **kwargs)
+
+            global active
+
+            profile = Profile(name, settings.profile_cpu, settings.profile_memory)
+            active = profile
+
+            try:
+                out = profile.call(func, *args, **kwargs)
+            except BaseException:
+                profile.finish()
+                raise
+
+            # Generators do their work after they are returned
+            if isinstance(out, Iterator):
+                return profile_iter(out, profile)
+
+            profile.finish()
+            return out
+
+        return wrapper
+
+    return decorator
+
+
+# Profiles every route of the proxy, see profiled()
+class ProfilingPlugin:
+    name = "profiling"
+    api = 2
+
+    def apply(self, callback: Callable, route) -> Callable:
+        return profiled(route.rule)(callback)
@@ -1,40 +1,693 @@
-from base64 import urlsafe_b64decode
+import hmac
+import itertools
+import json
+import time
 from typing import *
+from xml.etree import ElementTree
 
-import json
 import requests
-from bottle import Bottle, abort, request, response
+import xbmc
+from bottle import Bottle, HTTPResponse, abort, request, response
+
+from . import utils
+from .api import AmazonAuth, AmazonToken, AmazonURL, get_cdn_session, get_session
+from .broker import TokenBroker
+from .cache import CacheEntry, DiskCache, LRUCache
+from .cdn import CDNSelector, UrlSet
+from .compression import Compressor, accepted_encoding, compress_body, compress_chunks
+from .endpoint import get_endpoint, license_url
+from .mpd import PIPELINE, PatchOptions, stream_mpd
+from .profiling import ProfilingPlugin
+from .server import ProxyServer
+from .sessions import SessionRegistry
+from .stats import (
+    SIZE_BUCKETS,
+    TIME_BUCKETS,
+    Collector,
+    Counter,
+    Histogram,
+    Latency,
+    Registry,
+)
+from .subtitles import FORMATS, convert_ttml
+from .utils import (
+    HOST,
+    PORT,
+    RESOURCES_TTL,
+    SERVICE_KEY_HEADER,
+    compress_responses,
+    create_service_key,
+    is_browser,
+    log,
+    prefer_atmos,
+    profile_path,
+    proxy_workers,
+    skip_stages,
+)
+
+# Patched manifests are kept around, because IS.A requests the same
+# manifest again on seeks, stream restarts and resumes.
+MANIFEST_CACHE_SIZE = 16 * 1024 * 1024
+MANIFEST_CACHE_TTL = 10 * 60
+
+# Manifests are patched while they are downloaded, in chunks of this size
+MANIFEST_CHUNK_SIZE = 64 * 1024
+
+# A CDN that doesn't connect within the first, or stops sending the
+# manifest for the second number of seconds counts as failed, and the
+# next one is tried
+MANIFEST_TIMEOUT = (3, 10)
 
-from .api import HEADERS
-from .mpd import patch_mpd
+# Content codings that upstream servers may use for manifests and
+# subtitles. They are decoded while the response is being read.
+UPSTREAM_ENCODINGS = "gzip, deflate"
 
-HOST = "localhost"
-PORT = 26473
+# Playback resources of recently played titles, so that resuming a title
+# doesn't ask Amazon for the same URLs again. Every entry has its own
+# lifetime, depending on how long the URLs in it are valid.
+RESOURCES_CACHE_SIZE = 2 * 1024 * 1024
+
+# Converted subtitles are stored in the addon profile, so that switching
+# tracks or playing a title again does not download them again
+SUBTITLE_CACHE_SIZE = 32 * 1024 * 1024
+SUBTITLE_CHUNK_SIZE = 64 * 1024
+
+# Patched manifests are shared by the sessions that play the same content,
+# see sessions.content_key. The subtitle URLs in them carry this mark
+# instead of the ID of a session, which is filled in when they are sent.
+SESSION_MARK = "{session}"
+
+SUBTITLE_CONTENT_TYPES = {
+    "vtt": "text/vtt",
+    "srt": "application/x-subrip",
+}
 
 app = Bottle()
+server = None
+broker = TokenBroker()
+manifests = LRUCache(MANIFEST_CACHE_SIZE, MANIFEST_CACHE_TTL)
+sessions = SessionRegistry()
+resources = LRUCache(RESOURCES_CACHE_SIZE, RESOURCES_TTL)
+subtitles = None
+cdns = None
+service_key = None
+licenses = Latency()
+
+metrics = Registry()
+
+requests_total = metrics.add(
+    Counter("proxy_requests_total", "Requests to the proxy", ["route", "status"])
+)
+upstream_seconds = metrics.add(
+    Histogram(
+        "proxy_upstream_seconds",
+        "Time until the headers of an upstream response arrived",
+        TIME_BUCKETS,
+        ["kind"],
+    )
+)
+upstream_errors = metrics.add(
+    Counter(
+        "proxy_upstream_errors_total",
+        "Upstream responses with an error status",
+        ["kind", "status"],
+    )
+)
+patch_seconds = metrics.add(
+    Histogram("proxy_patch_seconds", "Time spent patching a manifest", TIME_BUCKETS)
+)
+response_bytes = metrics.add(
+    Histogram(
+        "proxy_response_bytes",
+        "Size of the manifests and subtitles sent to IS.A",
+        SIZE_BUCKETS,
+        ["route", "cache"],
+    )
+)
+upstream_bytes = metrics.add(
+    Counter(
+        "proxy_upstream_bytes_total",
+        "Size of upstream responses on the wire and after decoding",
+        ["kind", "stage"],
+    )
+)
+compression_bytes = metrics.add(
+    Counter(
+        "proxy_compression_bytes_total",
+        "Size of compressed responses before and after compression",
+        ["route", "encoding", "stage"],
+    )
+)
+compression_seconds = metrics.add(
+    Counter(
+        "proxy_compression_cpu_seconds_total",
+        "CPU time spent compressing responses",
+        ["route", "encoding"],
+    )
+)
+session_seconds = metrics.add(
+    Histogram(
+        "proxy_session_seconds",
+        "Time spent registering a playback session",
+        TIME_BUCKETS,
+    )
+)
+
+
+# Counts a streamed response once its body is done. A body that fails
+# after the headers were sent counts as a server error.
+def count_stream(out: Iterator, route: str, status: int) -> Iterator:
+    try:
+        yield from out
+    except Exception:
+        status = 500
+        raise
+    finally:
+        requests_total.inc(route, status)
+
+
+# Counts every request by route and status, including
+# the ones that fail with an exception
+class MetricsPlugin:
+    name = "metrics"
+    api = 2
+
+    def apply(self, callback: Callable, route) -> Callable:
+        def wrapper(*args, **kwargs):
+            status = 500
+
+            try:
+                out = callback(*args, **kwargs)
+                status = response.status_code
+            except HTTPResponse as e:
+                requests_total.inc(route.rule, e.status_code)
+                raise
+            except BaseException:
+                requests_total.inc(route.rule, status)
+                raise
+
+            if isinstance(out, Iterator):
+                return count_stream(out, route.rule, status)
+
+            requests_total.inc(route.rule, status)
+            return out
+
+        return wrapper
+
+
+def compressed(route: str, compressor: Compressor) -> None:
+    encoding = compressor.encoding
+
+    compression_bytes.inc(route, encoding, "in", amount=compressor.size)
+    compression_bytes.inc(route, encoding, "out", amount=compressor.compressed)
+    compression_seconds.inc(route, encoding, amount=compressor.cpu)
+
+    log("Compressed {} {}".format(route, compressor), xbmc.LOGDEBUG)
+
+
+# Compresses the responses of routes with compress=True, if the client
+# accepts it and it is enabled in the settings. Streamed responses are
+# compressed chunk by chunk.
+class CompressionPlugin:
+    name = "compression"
+    api = 2
+
+    def apply(self, callback: Callable, route) -> Callable:
+        if not route.config.get("compress"):
+            return callback
+
+        def wrapper(*args, **kwargs):
+            out = callback(*args, **kwargs)
+
+            if response.status_code != 200 or not compress_responses():
+                return out
+
+            encoding = accepted_encoding(request.headers.get("Accept-Encoding", ""))
+            if encoding is None:
+                return out
+
+            response.set_header("Content-Encoding", encoding)
+            response.set_header("Vary", "Accept-Encoding")
+
+            compressor = Compressor(encoding)
+
+            if isinstance(out, bytes):
+                out = compress_body(out, compressor)
+                compressed(route.rule, compressor)
+                return out
+
+            return compress_chunks(
+                out, compressor, lambda: compressed(route.rule, compressor)
+            )
+
+        return wrapper
+
+
+# Rejects requests to routes with private=True that don't carry the
+# key of the service, see utils.create_service_key
+class ServiceKeyPlugin:
+    name = "service_key"
+    api = 2
+
+    def apply(self, callback: Callable, route) -> Callable:
+        if not route.config.get("private"):
+            return callback
+
+        def wrapper(*args, **kwargs):
+            given = request.headers.get(SERVICE_KEY_HEADER, "")
+
+            if service_key is None or not hmac.compare_digest(given, service_key):
+                abort(403, "Invalid service key")
+
+            return callback(*args, **kwargs)
+
+        return wrapper
+
+
+app.install(MetricsPlugin())
+app.install(ServiceKeyPlugin())
+app.install(CompressionPlugin())
+app.install(ProfilingPlugin())
+
+
+def cache_metrics(name: str) -> Callable[[], Dict[Tuple, float]]:
+    def func() -> Dict[Tuple, float]:
+        caches = {"manifests": manifests, "resources": resources}
+        if subtitles is not None:
+            caches["subtitles"] = subtitles
+
+        return {(cache,): c.stats()[name] for cache, c in caches.items()}
+
+    return func
+
+
+for stat, name, kind, help in [
+    ("entries", "proxy_cache_entries", "gauge", "Entries in the proxy caches"),
+    ("size", "proxy_cache_bytes", "gauge", "Size of the proxy caches"),
+    ("hits", "proxy_cache_hits_total", "counter", "Hits of the proxy caches"),
+    ("misses", "proxy_cache_misses_total", "counter", "Misses of the proxy caches"),
+    ("evictions", "proxy_cache_evictions_total", "counter", "Evicted entries"),
+]:
+    metrics.add(Collector(name, help, kind, ["cache"], cache_metrics(stat)))
+
+
+# Records the time until the response headers arrived and the status
+# of responses that failed
+def upstream(kind: str, resp) -> None:
+    upstream_seconds.observe(resp.elapsed.total_seconds(), kind)
+
+    if resp.status_code >= 400:
+        upstream_errors.inc(kind, resp.status_code)
+
+
+# Requests the manifest from the url sets of the session, from the best
+# CDN to the worst, until one of them answers. Only connection errors
+# and server errors move on to the next CDN, other errors would be the
+# same on all of them.
+def fetch_manifest(session, headers: Dict) -> Tuple[UrlSet, requests.Response]:
+    sets = cdns.rank(session.sets)
+
+    for i, s in enumerate(sets):
+        last = i == len(sets) - 1
+
+        try:
+            resp = get_cdn_session().get(
+                s.url, headers=headers, stream=True, timeout=MANIFEST_TIMEOUT
+            )
+        except requests.RequestException as e:
+            log("Manifest request to {} failed: {}".format(s.cdn, e), xbmc.LOGWARNING)
+            cdns.fail(s.cdn)
+
+            if last:
+                abort(502, "No CDN could deliver the manifest")
+
+            continue
+
+        upstream("manifest", resp)
+
+        if resp.status_code < 500:
+            cdns.record(s.cdn, resp.elapsed.total_seconds())
+            return s, resp
+
+        msg = "Manifest request to {}: {}".format(s.cdn, resp.status_code)
+        log(msg, xbmc.LOGWARNING)
+        cdns.fail(s.cdn)
+
+        if last:
+            return s, resp
+
+        resp.close()
+
+
+# Reads the body of an upstream response, and counts its size on the
+# wire and after the content coding was removed
+def upstream_body(kind: str, resp, chunk_size: int) -> Iterator[bytes]:
+    size = 0
+
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        size += len(chunk)
+        yield chunk
+
+    upstream_bytes.inc(kind, "wire", amount=resp.raw.tell())
+    upstream_bytes.inc(kind, "decoded", amount=size)
+
+
+def with_session(manifest: bytes, session) -> bytes:
+    return manifest.replace(SESSION_MARK.encode(), session.id.encode())
+
+
+# Writes the patched manifest to the client while it is being produced,
+# and stores the complete result in the cache afterwards. If the manifest
+# breaks off, the response does too, without its last chunk, see
+# server.ProxyServerHandler.
+def stream_manifest(
+    key: Hashable, session, chunks: Iterable[str], resp, options: PatchOptions
+) -> Iterator[bytes]:
+    parts = []
+
+    try:
+        for chunk in chunks:
+            data = chunk.encode()
+            parts.append(data)
+
+            # A chunk is always a complete element, so the mark is never split
+            yield with_session(data, session)
+    except Exception as e:
+        log("Manifest stream failed: {}".format(e), xbmc.LOGWARNING)
+        raise
+    finally:
+        resp.close()
+
+    entry = CacheEntry(
+        b"".join(parts),
+        resp.headers.get("ETag"),
+        resp.headers.get("Last-Modified"),
+    )
+    manifests.put(key, entry)
+
+    patch_seconds.observe(sum(result.time for result in options.results))
+    response_bytes.observe(len(entry.value), "/mpd", "miss")
+
+    log("Manifest cache miss: {}".format(manifests.stats()), xbmc.LOGDEBUG)
+
+    for result in options.results:
+        log("Manifest stage {}".format(result), xbmc.LOGDEBUG)
+
+
+@app.get("/mpd", compress=True)
+def mpd() -> Iterable[bytes]:
+    atmos = prefer_atmos()
+
+    # Stages of the patch pipeline that should not run. They are switched
+    # off in the settings, or for a single request while debugging, for
+    # example ?skip=split_adaptation_sets,patch_audio_metadata
+    skip = request.query.get("skip", "")
+    skip = frozenset(s for s in skip.split(",") if s in PIPELINE.names())
+    skip |= skip_stages()
+
+    session = sessions.get(request.query.get("session"))
+    if session is None:
+        abort(404, "Unknown playback session")
 
+    key = (session.content, atmos, skip)
 
-def urlb64(i: str) -> str:
-    return urlsafe_b64decode(i).decode()
+    response.content_type = "application/xml+dash"
+
+    entry, fresh = manifests.get(key)
+    if fresh:
+        log("Manifest cache hit: {}".format(manifests.stats()), xbmc.LOGDEBUG)
+        response_bytes.observe(len(entry.value), "/mpd", "hit")
+        return with_session(entry.value, session)
+
+    headers = {"Accept-Encoding": UPSTREAM_ENCODINGS}
+    if entry is not None:
+        headers.update(entry.validators())
 
+    host, resp = fetch_manifest(session, headers)
+    log("Manifest from {}".format(host.cdn), xbmc.LOGDEBUG)
 
-@app.get("/mpd")
-def mpd() -> str:
-    url = urlb64(request.query.get("url"))
-    subs = json.loads(urlb64(request.query.get("subs")))
-    forced = json.loads(urlb64(request.query.get("forced")))
+    # The cached copy is still valid, so there is nothing to patch
+    if resp.status_code == 304 and entry is not None:
+        resp.close()
+        manifests.revalidate(key)
+        response_bytes.observe(len(entry.value), "/mpd", "revalidated")
+        return with_session(entry.value, session)
 
-    resp = requests.get(url, headers=HEADERS)
     if resp.status_code != 200:
         abort(resp.status_code, resp.text)
 
-    response.content_type = "application/xml+dash"
-    return patch_mpd(url, resp.text, subs, forced)
+    proxy = "http://{}:{}/subtitle?session={}".format(HOST, PORT, SESSION_MARK)
+    options = PatchOptions(host.url, session.subs, session.forced, atmos, skip, proxy)
+
+    chunks = upstream_body("manifest", resp, MANIFEST_CHUNK_SIZE)
+    chunks = stream_mpd(chunks, options)
+
+    # Nothing is written before the first Period was patched, so a
+    # manifest that can't be read up to there fails with an error
+    # status instead of a truncated 200
+    try:
+        first = next(chunks)
+    except (ElementTree.ParseError, requests.RequestException) as e:
+        resp.close()
+        cdns.fail(host.cdn)
+
+        log("Manifest from {} failed: {}".format(host.cdn, e), xbmc.LOGWARNING)
+        abort(502, "Invalid manifest")
+
+    chunks = itertools.chain([first], chunks)
+
+    return stream_manifest(key, session, chunks, resp, options)
+
+
+# Same as stream_manifest, but for converted subtitles
+def stream_subtitle(key: str, chunks: Iterable[str]) -> Iterator[bytes]:
+    parts = []
+
+    for chunk in chunks:
+        data = chunk.encode()
+        parts.append(data)
+
+        yield data
+
+    value = b"".join(parts)
+
+    subtitles.put(key, value)
+    response_bytes.observe(len(value), "/subtitle", "miss")
+
+    log("Subtitle cache miss: {}".format(subtitles.stats()), xbmc.LOGDEBUG)
+
+
+@app.get("/subtitle", compress=True)
+def subtitle() -> Iterable[bytes]:
+    fmt = request.query.get("format", "vtt")
+    if fmt not in FORMATS:
+        abort(400, "Unsupported subtitle format: {}".format(fmt))
+
+    session = sessions.get(request.query.get("session"))
+    if session is None:
+        abort(404, "Unknown playback session")
+
+    track = request.query.get("track")
+    if not track:
+        abort(400, "Missing subtitle track")
+
+    # Only tracks of the session are fetched, so the cache can't be
+    # filled with anything but the subtitles that Amazon sent for them
+    url = session.subtitle_url(track)
+    if url is None:
+        abort(404, "Unknown subtitle track")
+
+    # The URLs are signed and change with every playback,
+    # but the track IDs stay the same
+    key = "{}.{}".format(track, fmt)
+
+    response.content_type = SUBTITLE_CONTENT_TYPES[fmt]
+
+    value = subtitles.get(key)
+    if value is not None:
+        log("Subtitle cache hit: {}".format(key), xbmc.LOGDEBUG)
+        response_bytes.observe(len(value), "/subtitle", "hit")
+        return value
+
+    headers = {"Accept-Encoding": UPSTREAM_ENCODINGS}
+    resp = get_session().get(url, headers=headers, stream=True)
+    upstream("subtitle", resp)
+
+    if resp.status_code != 200:
+        abort(resp.status_code, resp.text)
+
+    chunks = upstream_body("subtitle", resp, SUBTITLE_CHUNK_SIZE)
+    chunks = convert_ttml(chunks, fmt)
+
+    return stream_subtitle(key, chunks)
+
+
+# Forwards the Widevine challenge from IS.A to Amazon. The auth headers
+# are added here instead of in play(), so that license renewals during
+# long playbacks never use an expired token.
+@app.post("/license")
+def post_license() -> bytes:
+    session = sessions.get(request.query.get("session"))
+    if session is None:
+        abort(404, "Unknown playback session")
+
+    start = time.perf_counter()
+
+    use_cookies = is_browser()
+    token = broker.refresh(session.endpoint, use_cookies)
+    auth = AmazonAuth(token, session.endpoint, use_cookies, broker.save)
+
+    headers = {"Content-Type": request.content_type}
+    resp = get_session().post(
+        session.license, data=request.body.read(), headers=headers, auth=auth
+    )
+
+    elapsed = time.perf_counter() - start
+    licenses.record(elapsed, resp.status_code == 200)
+    upstream("license", resp)
+
+    log("License request: {:.2f}ms".format(elapsed * 1000), xbmc.LOGDEBUG)
+
+    if resp.status_code != 200:
+        abort(resp.status_code, resp.text)
+
+    response.content_type = resp.headers.get("Content-Type", "application/json")
+    return resp.content
+
+
+@app.get("/debug/mpd")
+def debug_mpd() -> Dict:
+    return {
+        "stages": PIPELINE.stats(),
+        "cache": manifests.stats(),
+    }
+
+
+@app.get("/debug/subtitles")
+def debug_subtitles() -> Dict:
+    return subtitles.stats()
+
+
+@app.get("/metrics")
+def get_metrics() -> str:
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.render()
+
+
+@app.get("/debug/cdn")
+def debug_cdn() -> Dict:
+    return cdns.stats()
+
+
+@app.get("/debug/license")
+def debug_license() -> Dict:
+    return licenses.stats()
+
+
+@app.post("/session", private=True)
+def post_session() -> Dict:
+    data = request.json
+
+    token = broker.get()
+    if token is None:
+        abort(401, "Not logged in")
+
+    start = time.perf_counter()
+
+    # The license requests carry the auth headers of the account, so
+    # their URL is built here, for the endpoint of the account, and
+    # never taken from the client. The endpoint is usually in memory
+    # since the warm-up.
+    url, marketplace = get_endpoint(token)
+    lic = license_url(data["asin"], (url, marketplace))
+
+    sets = [UrlSet.from_dict(s) for s in data["sets"]]
+
+    # Scores that are recent enough are used as they are, which keeps the
+    # probes off most playbacks. play() waits for this request, so the
+    # others are probed in the background.
+    if cdns.needs_probe(sets):
+        cdns.start_probe(sets)
+
+    id = sessions.register(sets, data["subs"], data["forced"], lic, url)
+
+    elapsed = time.perf_counter() - start
+    session_seconds.observe(elapsed)
+
+    log("Session registered: {:.2f}ms".format(elapsed * 1000), xbmc.LOGDEBUG)
+
+    return {"id": id}
+
+
+@app.delete("/session/<id>", private=True)
+def delete_session(id: str) -> Dict:
+    sessions.remove(id)
+    return {}
+
+
+@app.get("/resources", private=True)
+def get_resources() -> Dict:
+    entry, fresh = resources.get(request.query.get("key"))
+    if not fresh:
+        return {"resources": None}
+
+    return {"resources": json.loads(entry.value)}
+
+
+@app.post("/resources", private=True)
+def post_resources() -> Dict:
+    data = request.json
+    entry = CacheEntry(json.dumps(data["resources"]).encode(), ttl=data["ttl"])
+
+    resources.put(data["key"], entry)
+    return {}
+
+
+# The process that runs the proxy owns the token, see utils.broker
+@app.get("/token", private=True)
+def get_token() -> Dict:
+    domain = request.query.get("domain")
+
+    if domain:
+        url = AmazonURL(domain)
+        use_cookies = request.query.get("cookies") == "1"
+        margin = float(request.query.get("margin", 0))
+
+        token = broker.refresh(url, use_cookies, margin)
+    else:
+        token = broker.get()
+
+    return {"token": None if token is None else token.to_dict()}
+
+
+@app.post("/token", private=True)
+def post_token() -> Dict:
+    broker.save(AmazonToken.from_dict(request.json))
+    return {}
+
+
+@app.delete("/token", private=True)
+def delete_token() -> Dict:
+    broker.clear()
+    return {}
 
 
 def start_proxy() -> None:
-    app.run(host="localhost", port=26473)
+    global server, subtitles, cdns, service_key
+
+    utils.broker = broker
+    service_key = create_service_key()
+    subtitles = DiskCache(profile_path("subtitles"), SUBTITLE_CACHE_SIZE)
+    cdns = CDNSelector(profile_path("cdn.json"))
+
+    # bottle's default server handles one request at a time, which makes
+    # every request from IS.A wait for a slow upstream manifest fetch
+    server = ProxyServer(host=HOST, port=PORT, workers=proxy_workers())
+    app.run(server=server)
 
 
 def stop_proxy() -> None:
+    if server is not None:
+        server.shutdown()
+
     app.close()
@@ -0,0 +1,99 @@
+import threading
+from typing import *
+
+import xbmc
+
+from .api import AmazonAuth, token_time
+from .broker import TokenBroker
+from .endpoint import get_endpoint
+from .utils import *
+
+# Tokens are refreshed this many seconds before they expire, so that
+# requests during playback never have to wait for a refresh
+REFRESH_AHEAD = 15 * 60
+
+# Failed refreshes are retried after BACKOFF_MIN seconds, and the
+# delay doubles with every failure, up to BACKOFF_MAX
+BACKOFF_MIN = 30
+BACKOFF_MAX = 30 * 60
+
+
+# Refreshes the token of the broker ahead of its expiry. The time of the
+# next refresh is only computed when the token changes, so poll() is
+# cheap enough to be called every second by the service. The refresh
+# itself runs on a thread of its own, so that a slow network never
+# blocks the service loop.
+class RefreshScheduler:
+    broker: TokenBroker
+    deadline: float
+    version: int
+    use_cookies: bool
+    failures: int
+    thread: threading.Thread
+
+    def __init__(self, broker: TokenBroker):
+        self.broker = broker
+        self.deadline = None
+        self.version = None
+        self.use_cookies = None
+        self.failures = 0
+        self.thread = None
+
+    def poll(self) -> None:
+        # The refresh updates the schedule when it is done
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        use_cookies = is_browser()
+
+        # Saved by a login, a refresh or any other request
+        if self.broker.version != self.version or use_cookies != self.use_cookies:
+            self.failures = 0
+            self.schedule()
+
+        if self.deadline is None or token_time() < self.deadline:
+            return
+
+        self.thread = threading.Thread(target=self.refresh, name="refresh", daemon=True)
+        self.thread.start()
+
+    def schedule(self) -> None:
+        self.version = self.broker.version
+        self.use_cookies = is_browser()
+
+        auth = AmazonAuth(self.broker.get(), None, self.use_cookies, None)
+        expiry = auth.expiry()
+
+        if expiry is None:
+            self.deadline = None
+            return
+
+        self.deadline = expiry - REFRESH_AHEAD
+
+        delay = self.deadline - token_time()
+        log("Next token refresh in {:.0f}s".format(max(delay, 0)), xbmc.LOGDEBUG)
+
+    def refresh(self) -> None:
+        token = self.broker.get()
+
+        try:
+            url, _ = get_endpoint(token)
+            self.broker.refresh(url, self.use_cookies, REFRESH_AHEAD)
+        except Exception as e:
+            self.failures += 1
+
+            delay = min(BACKOFF_MIN * 2 ** (self.failures - 1), BACKOFF_MAX)
+            self.deadline = token_time() + delay
+
+            log(
+                "Token refresh failed, retrying in {}s: {}".format(delay, e),
+                xbmc.LOGWARNING,
+            )
+            return
+
+        self.failures = 0
+        self.schedule()
+
+        # Never hammer the API with a token that expires too soon anyway
+        if self.deadline is not None and self.deadline <= token_time():
+            self.deadline = token_time() + BACKOFF_MIN
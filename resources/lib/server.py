@@ -0,0 +1,192 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+from wsgiref.simple_server import (
+    ServerHandler,
+    WSGIRequestHandler,
+    WSGIServer,
+    make_server,
+)
+
+import xbmc
+from bottle import ServerAdapter
+
+from .utils import log
+
+# Idle keep-alive connections are dropped after this many seconds,
+# so that they don't block a worker forever
+KEEPALIVE_TIMEOUT = 15
+
+
+# Streamed responses have no length. They are sent with the chunked
+# transfer coding, so that the connection can be reused, and so that
+# the client can tell a complete body from one that broke off, because
+# only a complete one ends with the last chunk.
+class ProxyServerHandler(ServerHandler):
+    http_version = "1.1"
+    chunked = False
+
+    def cleanup_headers(self) -> None:
+        super().cleanup_headers()
+
+        if "Content-Length" not in self.headers:
+            if self.has_body() and self.request_handler.request_version == "HTTP/1.1":
+                self.chunked = True
+                self.headers["Transfer-Encoding"] = "chunked"
+            else:
+                self.request_handler.close_connection = True
+
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+    def has_body(self) -> bool:
+        if self.environ["REQUEST_METHOD"] == "HEAD":
+            return False
+
+        return not self.status.startswith(("1", "204", "304"))
+
+    def write(self, data: bytes) -> None:
+        if not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+
+        if self.chunked:
+            # An empty chunk would end the body
+            if not data:
+                return
+
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+
+        self._write(data)
+        self._flush()
+
+    def finish_content(self) -> None:
+        super().finish_content()
+
+        if self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+
+    def handle_error(self) -> None:
+        # The response might be half written, don't reuse the connection
+        self.request_handler.close_connection = True
+        super().handle_error()
+
+
+class ProxyRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def handle(self) -> None:
+        self.close_connection = True
+        self.handle_one_request()
+
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self) -> None:
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        # Sets close_connection depending on the HTTP version and the
+        # Connection header. An empty line means the client is gone.
+        if not self.parse_request():
+            self.close_connection = True
+            return
+
+        handler = ProxyServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def address_string(self) -> str:
+        return self.client_address[0]
+
+    def log_message(self, format: str, *args) -> None:
+        log("Proxy: " + format % args, xbmc.LOGDEBUG)
+
+
+class ThreadPoolServer(WSGIServer):
+    pool: ThreadPoolExecutor
+    connections: Set[socket.socket]
+
+    def server_activate(self) -> None:
+        super().server_activate()
+
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address) -> None:
+        with self.connections_lock:
+            self.connections.add(request)
+
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+            with self.connections_lock:
+                self.connections.discard(request)
+
+    # Idle keep-alive connections keep their worker waiting for the next
+    # request for up to KEEPALIVE_TIMEOUT. Shutting their sockets down
+    # ends the wait right away, so the workers can exit with the service.
+    def close_connections(self) -> None:
+        with self.connections_lock:
+            connections = list(self.connections)
+
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ProxyServer(ServerAdapter):
+    srv: ThreadPoolServer
+
+    def run(self, handler: Callable) -> None:
+        workers = max(1, self.options.get("workers", 8))
+
+        self.srv = make_server(
+            self.host,
+            self.port,
+            handler,
+            server_class=ThreadPoolServer,
+            handler_class=ProxyRequestHandler,
+        )
+        self.srv.pool = ThreadPoolExecutor(workers, thread_name_prefix="proxy")
+        self.srv.serve_forever()
+
+    def shutdown(self) -> None:
+        srv = getattr(self, "srv", None)
+        if srv is None:
+            return
+
+        srv.shutdown()
+        srv.server_close()
+        srv.close_connections()
+        srv.pool.shutdown(wait=False)
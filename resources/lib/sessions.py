@@ -0,0 +1,119 @@
+import hashlib
+import json
+import secrets
+import threading
+import time
+from typing import *
+
+from .api import AmazonURL
+from .cdn import UrlSet
+
+# Sessions that are never started or never stopped (for example because
+# Kodi crashed) are dropped after this many seconds without a request
+SESSION_MAX_IDLE = 12 * 60 * 60
+
+
+# Identifies what a session plays, independent of its random ID. Resuming
+# a title within the lifetime of its playback resources registers a new
+# session with the same URLs, which can use the manifest of the old one.
+def content_key(sets: List[UrlSet], subs: List[Dict], forced: List[Dict]) -> str:
+    data = {
+        "sets": [s.to_dict() for s in sets],
+        "subs": subs,
+        "forced": forced,
+    }
+
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class PlaybackSession:
+    id: str
+    sets: List[UrlSet]
+    subs: List[Dict]
+    forced: List[Dict]
+    license: str
+    endpoint: AmazonURL
+    content: str
+    used: float
+
+    def __init__(
+        self,
+        id: str,
+        sets: List[UrlSet],
+        subs: List[Dict],
+        forced: List[Dict],
+        license: str,
+        endpoint: AmazonURL,
+    ):
+        self.id = id
+        self.sets = sets
+        self.subs = subs
+        self.forced = forced
+        self.license = license
+        self.endpoint = endpoint
+        self.content = content_key(sets, subs, forced)
+        self.used = time.monotonic()
+
+    # The proxy only fetches subtitles of the tracks of the session
+    def subtitle_url(self, track: str) -> Optional[str]:
+        for sub in self.forced + self.subs:
+            if sub["timedTextTrackId"] == track:
+                return sub["url"]
+
+        return None
+
+
+# Holds the state of every playback that was started through the proxy.
+# play() registers the manifest URLs, the subtitle tracks and the license
+# URL once, and the proxy URLs only carry the short session ID from then on.
+class SessionRegistry:
+    sessions: Dict[str, PlaybackSession]
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def register(
+        self,
+        sets: List[UrlSet],
+        subs: List[Dict],
+        forced: List[Dict],
+        license: str,
+        endpoint: AmazonURL,
+    ) -> str:
+        with self.lock:
+            self.expire()
+
+            id = secrets.token_urlsafe(8)
+            while id in self.sessions:
+                id = secrets.token_urlsafe(8)
+
+            session = PlaybackSession(id, sets, subs, forced, license, endpoint)
+            self.sessions[id] = session
+
+            return id
+
+    def get(self, id: str) -> Optional[PlaybackSession]:
+        with self.lock:
+            session = self.sessions.get(id)
+
+            if session is not None:
+                session.used = time.monotonic()
+
+            return session
+
+    def remove(self, id: str) -> None:
+        with self.lock:
+            self.sessions.pop(id, None)
+
+    # Must be called with the lock held
+    def expire(self) -> None:
+        now = time.monotonic()
+
+        for id, session in list(self.sessions.items()):
+            if now - session.used > SESSION_MAX_IDLE:
+                del self.sessions[id]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.sessions)
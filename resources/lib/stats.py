@@ -0,0 +1,207 @@
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from typing import *
+
+
+# Round-trip times of upstream requests that are made on behalf of IS.A
+class Latency:
+    count: int
+    errors: int
+    total: float
+    min: float
+    max: float
+    last: float
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def record(self, time: float, ok: bool = True) -> None:
+        with self.lock:
+            self.count += 1
+            self.total += time
+            self.last = time
+
+            self.min = time if self.min is None else min(self.min, time)
+            self.max = time if self.max is None else max(self.max, time)
+
+            if not ok:
+                self.errors += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "average": self.total / self.count if self.count > 0 else None,
+                "min": self.min,
+                "max": self.max,
+                "last": self.last,
+            }
+
+
+# Latency buckets in seconds, and size buckets in bytes
+TIME_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [1024 * 4**i for i in range(10)]
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names: List[str], values: Tuple) -> str:
+    if len(names) == 0:
+        return ""
+
+    labels = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        labels.append('{}="{}"'.format(name, value.replace("\n", "\\n")))
+
+    return "{" + ",".join(labels) + "}"
+
+
+# The metrics below are rendered in the Prometheus text exposition format.
+# Recording a value only takes a lock and a few additions, all formatting
+# happens when the metrics are requested.
+class Metric(ABC):
+    name: str
+    help: str
+    kind: str
+    labels: List[str]
+
+    def __init__(self, name: str, help: str, kind: str, labels: List[str]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = [] if labels is None else labels
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+
+        lines += self.samples()
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    values: Dict[Tuple, float]
+
+    def __init__(self, name: str, help: str, labels: List[str] = None):
+        super().__init__(name, help, "counter", labels)
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+
+        return [
+            "{}{} {}".format(self.name, format_labels(self.labels, k), format_value(v))
+            for k, v in sorted(values)
+        ]
+
+
+class Histogram(Metric):
+    buckets: List[float]
+    values: Dict[Tuple, List]
+
+    def __init__(
+        self, name: str, help: str, buckets: List[float], labels: List[str] = None
+    ):
+        super().__init__(name, help, "histogram", labels)
+        self.buckets = sorted(buckets)
+        self.values = {}
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts, total = self.values.get(labels, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+
+            counts[index] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = [(k, (list(c), t)) for k, (c, t) in self.values.items()]
+
+        names = self.labels + ["le"]
+        lines = []
+
+        for labels, (counts, total) in sorted(values):
+            count = 0
+
+            for bound, n in zip(self.buckets + [float("inf")], counts):
+                count += n
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        format_labels(names, labels + (format_value(bound),)),
+                        count,
+                    )
+                )
+
+            labels = format_labels(self.labels, labels)
+            lines.append("{}_sum{} {}".format(self.name, labels, format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, labels, count))
+
+        return lines
+
+
+# Reads its values from a function when the metrics are requested,
+# for numbers that are already counted somewhere else
+class Collector(Metric):
+    func: Callable[[], Dict[Tuple, float]]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        kind: str,
+        labels: List[str],
+        func: Callable[[], Dict[Tuple, float]],
+    ):
+        super().__init__(name, help, kind, labels)
+        self.func = func
+
+    def samples(self) -> List[str]:
+        return [
+            "{}{} {}".format(self.name, format_labels(self.labels, k), format_value(v))
+            for k, v in sorted(self.func().items())
+        ]
+
+
+class Registry:
+    metrics: List[Metric]
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self.metrics)
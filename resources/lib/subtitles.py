@@ -0,0 +1,273 @@
+import re
+from typing import *
+from xml.etree import ElementTree
+
+TTML = "http://www.w3.org/ns/ttml"
+TTML_PARAMETER = "http://www.w3.org/ns/ttml#parameter"
+TTML_STYLING = "http://www.w3.org/ns/ttml#styling"
+
+P = "{%s}p" % TTML
+BR = "{%s}br" % TTML
+STYLE = "{%s}style" % TTML
+ID = "{http://www.w3.org/XML/1998/namespace}id"
+TICK_RATE = "{%s}tickRate" % TTML_PARAMETER
+FRAME_RATE = "{%s}frameRate" % TTML_PARAMETER
+FONT_STYLE = "{%s}fontStyle" % TTML_STYLING
+
+# 00:00:01.500 or 00:00:01:12 (with frames)
+CLOCK_TIME = re.compile(r"^(\d+):(\d{2}):(\d{2})(?:(\.\d+)|:(\d+(?:\.\d+)?))?$")
+
+# 1.5s, 1500ms, 36f, 15000000t
+OFFSET_TIME = re.compile(r"^(\d+(?:\.\d+)?)(h|m|s|ms|f|t)$")
+
+FORMATS = ["vtt", "srt"]
+
+
+class Timing:
+    tick_rate: float
+    frame_rate: float
+
+    def __init__(self, root: ElementTree.Element):
+        self.frame_rate = float(root.get(FRAME_RATE, 30))
+
+        # Without an explicit tick rate, ticks are frames if a frame rate
+        # is set, and seconds otherwise
+        default = self.frame_rate if FRAME_RATE in root.attrib else 1
+        self.tick_rate = float(root.get(TICK_RATE, default))
+
+    def parse(self, value: str) -> float:
+        value = value.strip()
+
+        m = CLOCK_TIME.match(value)
+        if m is not None:
+            hours, minutes, seconds, fraction, frames = m.groups()
+            time = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+            if fraction is not None:
+                time += float(fraction)
+
+            if frames is not None:
+                time += float(frames) / self.frame_rate
+
+            return time
+
+        m = OFFSET_TIME.match(value)
+        if m is None:
+            raise Exception("Invalid TTML time: {}".format(value))
+
+        count, unit = float(m.group(1)), m.group(2)
+
+        if unit == "h":
+            return count * 3600
+        if unit == "m":
+            return count * 60
+        if unit == "s":
+            return count
+        if unit == "ms":
+            return count / 1000
+        if unit == "f":
+            return count / self.frame_rate
+
+        return count / self.tick_rate
+
+
+def format_time(time: float, separator: str) -> str:
+    millis = int(round(time * 1000))
+
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    seconds, millis = divmod(millis, 1000)
+
+    return "{:02d}:{:02d}:{:02d}{}{:03d}".format(
+        hours, minutes, seconds, separator, millis
+    )
+
+
+def escape_vtt(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+# Returns the font style that an element sets itself or through the styles
+# that it references, or None if it inherits the one of its parent. Later
+# references win over earlier ones, and attributes over references.
+def font_style(
+    elem: ElementTree.Element, styles: Dict[str, Optional[str]]
+) -> Optional[str]:
+    value = elem.get(FONT_STYLE)
+    if value is not None:
+        return value
+
+    for ref in reversed(elem.get("style", "").split()):
+        value = styles.get(ref)
+        if value is not None:
+            return value
+
+    return None
+
+
+# Collects the text of an element as runs that are in italics or not
+def cue_runs(
+    elem: ElementTree.Element,
+    styles: Dict[str, Optional[str]],
+    italic: bool,
+    runs: List[Tuple[str, bool]],
+) -> None:
+    if elem.text:
+        runs.append((elem.text, italic))
+
+    for child in elem:
+        if child.tag == BR:
+            runs.append(("\n", italic))
+        else:
+            style = font_style(child, styles)
+            child_italic = italic if style is None else style == "italic"
+
+            cue_runs(child, styles, child_italic, runs)
+
+        if child.tail:
+            runs.append((child.tail, italic))
+
+
+def cue_text(
+    elem: ElementTree.Element,
+    escape: Callable[[str], str],
+    styles: Dict[str, Optional[str]],
+    italic: bool,
+) -> str:
+    runs = []
+    cue_runs(elem, styles, italic, runs)
+
+    # Neighbouring runs with the same style share one pair of tags
+    merged = []
+    for text, italic in runs:
+        italic = italic and len(text.strip()) > 0
+
+        if len(merged) > 0 and merged[-1][1] == italic:
+            merged[-1][0] += text
+        else:
+            merged.append([text, italic])
+
+    parts = []
+    for text, italic in merged:
+        text = escape(text)
+        parts.append("<i>" + text + "</i>" if italic else text)
+
+    return "".join(parts).strip()
+
+
+# The active interval of an element, in seconds from the start of the
+# document, and whether its text is in italics. Children of a time
+# container start relative to it and can't outlast it. Amazon only uses
+# parallel time containers, so sequential ones are treated the same way.
+class Scope:
+    elem: ElementTree.Element
+    begin: float
+    end: Optional[float]
+    italic: bool
+
+    def __init__(
+        self,
+        elem: ElementTree.Element,
+        parent: Optional["Scope"],
+        timing: "Timing",
+        styles: Dict[str, Optional[str]],
+    ):
+        offset = 0.0 if parent is None else parent.begin
+        limit = None if parent is None else parent.end
+
+        self.elem = elem
+        self.begin = offset
+
+        begin = elem.get("begin")
+        if begin is not None:
+            self.begin = offset + timing.parse(begin)
+
+        end = elem.get("end")
+        dur = elem.get("dur")
+
+        # Without an end of its own, an element ends with its parent
+        if end is not None:
+            self.end = offset + timing.parse(end)
+        elif dur is not None:
+            self.end = self.begin + timing.parse(dur)
+        else:
+            self.end = limit
+
+        if limit is not None and self.end is not None:
+            self.end = min(self.end, limit)
+
+        style = font_style(elem, styles)
+        if style is None:
+            self.italic = parent is not None and parent.italic
+        else:
+            self.italic = style == "italic"
+
+
+# Converts TTML subtitles to WebVTT or SRT while they are being parsed.
+# Every <p> is turned into a cue and dropped as soon as it is complete,
+# so the full document is never held in memory. The styles in the head
+# come before the body, so they are known by the time they are used.
+def convert_ttml(chunks: Iterable[bytes], fmt: str = "vtt") -> Iterator[str]:
+    if fmt not in FORMATS:
+        raise Exception("Unsupported subtitle format: {}".format(fmt))
+
+    vtt = fmt == "vtt"
+    escape = escape_vtt if vtt else lambda text: text
+    separator = "." if vtt else ","
+
+    if vtt:
+        yield "WEBVTT\n\n"
+
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    stack = []
+    styles = {}
+    timing = None
+    index = 0
+
+    def events() -> Iterator[Tuple[str, ElementTree.Element]]:
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from parser.read_events()
+
+        parser.close()
+        yield from parser.read_events()
+
+    for event, elem in events():
+        if event == "start":
+            if timing is None:
+                timing = Timing(elem)
+
+            parent = stack[-1] if len(stack) > 0 else None
+
+            # The text of a cue is styled by cue_text(), and its timing
+            # is the one of the <p>, so its children share the scope
+            if parent is not None and parent.elem.tag == P:
+                stack.append(parent)
+            else:
+                stack.append(Scope(elem, parent, timing, styles))
+
+            continue
+
+        scope = stack.pop()
+
+        if elem.tag == STYLE and ID in elem.attrib:
+            styles[elem.get(ID)] = font_style(elem, styles)
+            continue
+
+        if elem.tag != P:
+            continue
+
+        if scope.end is not None and scope.end > scope.begin:
+            text = cue_text(elem, escape, styles, scope.italic)
+
+            if len(text) > 0:
+                index += 1
+
+                start = format_time(scope.begin, separator)
+                stop = format_time(scope.end, separator)
+
+                cue = "{} --> {}\n{}\n\n".format(start, stop, text)
+                yield cue if vtt else "{}\n{}".format(index, cue)
+
+        if len(stack) > 0:
+            stack[-1].elem.remove(elem)
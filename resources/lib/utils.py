@@ -1,42 +1,169 @@
+import hashlib
 import json
 import os
 import os.path
+import secrets
+import tempfile
+import threading
+import time
+import urllib.request
 import uuid
 from typing import *
+from urllib.parse import urlencode
 
 import xbmc
 import xbmcaddon
 import xbmcvfs
 
-from .api import DEVICE_TYPE_ANDROID, DEVICE_TYPE_BROWSER, AmazonToken
+from .api import DEVICE_TYPE_ANDROID, DEVICE_TYPE_BROWSER, AmazonToken, AmazonURL
 
+ADDON_ID = "plugin.video.tmsp-amazon"
 
-def save_token(token: AmazonToken) -> None:
+
+def log(msg: str, level: int = xbmc.LOGINFO) -> None:
+    xbmc.log("[{}] {}".format(ADDON_ID, msg), level)
+
+
+def profile_path(name: str) -> str:
     addon = xbmcaddon.Addon()
 
-    path = os.path.join(addon.getAddonInfo("profile"), "token.json")
-    path = xbmcvfs.translatePath(path)
+    path = os.path.join(addon.getAddonInfo("profile"), name)
+    return xbmcvfs.translatePath(path)
 
-    os.makedirs(os.path.dirname(path), exist_ok=True)
 
+# Writes to a temporary file next to path first, so that readers never
+# see a half written file. Plugin invocations and the service can write
+# the same file at the same time, so every writer gets its own
+# temporary file, and the last complete one wins.
+def atomic_write(path: str, data: bytes) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+        raise
+
+
+# The service owns the current token and sets this to its TokenBroker.
+# Plugin invocations talk to the broker through the proxy instead, and
+# only fall back to the token file if the service is not reachable.
+broker = None
+
+# Where the service runs the proxy. Defined here instead of in the proxy
+# module, so that plugin invocations don't have to import the proxy.
+HOST = "localhost"
+PORT = 26473
+
+SERVICE_URL = "http://{}:{}".format(HOST, PORT)
+BROKER_TIMEOUT = 2
+
+# Any local process can connect to the proxy, so the routes that hand out
+# the token or change the state of the service require a key. The service
+# creates a new one on every start, in a file that only Kodi can read.
+SERVICE_KEY_FILE = "service.key"
+SERVICE_KEY_HEADER = "X-Service-Key"
+
+# Playback resources without a known expiry are reused for this many
+# seconds. Shared by the plugin, which picks the lifetime of an entry,
+# and the proxy, which uses it for entries that don't have one.
+RESOURCES_TTL = 5 * 60
+
+
+def create_service_key() -> str:
+    key = secrets.token_urlsafe(32)
+
+    # The temporary file of atomic_write() is only readable by its owner
+    atomic_write(profile_path(SERVICE_KEY_FILE), key.encode())
+    return key
+
+
+def read_service_key() -> Optional[str]:
+    try:
+        with open(profile_path(SERVICE_KEY_FILE)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def service_request(
+    method: str, path: str, query: Dict = None, data: Dict = None
+) -> Dict:
+    url = SERVICE_URL + path
+    if query is not None:
+        url += "?" + urlencode(query)
+
+    body = None
+    if data is not None:
+        body = json.dumps(data).encode()
+
+    req = urllib.request.Request(url, data=body, method=method)
+    req.add_header("Content-Type", "application/json")
+
+    key = read_service_key()
+    if key is not None:
+        req.add_header(SERVICE_KEY_HEADER, key)
+
+    with urllib.request.urlopen(req, timeout=BROKER_TIMEOUT) as resp:
+        return json.load(resp)
+
+
+def broker_request(method: str, query: Dict = None, data: Dict = None) -> Dict:
+    return service_request(method, "/token", query, data)
+
+
+# Playback resources are cached by the service. Without it,
+# they are simply requested again.
+def load_resources(key: str) -> Optional[Dict]:
+    try:
+        return service_request("GET", "/resources", {"key": key})["resources"]
+    except (OSError, ValueError):
+        return None
+
+
+def save_resources(key: str, resources: Dict, ttl: float) -> None:
+    data = {"key": key, "resources": resources, "ttl": ttl}
+
+    try:
+        service_request("POST", "/resources", data=data)
+    except (OSError, ValueError):
+        pass
+
+
+# Hands the state of a new playback to the proxy, which returns the ID
+# that identifies it in the manifest and license URLs
+def register_session(
+    asin: str, sets: List[Dict], subs: List[Dict], forced: List[Dict]
+) -> str:
     data = {
-        "access": token.access,
-        "refresh": token.refresh,
-        "expires": token.expires,
-        "cookies": token.cookies,
+        "asin": asin,
+        "sets": sets,
+        "subs": subs,
+        "forced": forced,
     }
 
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    return service_request("POST", "/session", data=data)["id"]
 
 
-def load_token() -> AmazonToken:
-    addon = xbmcaddon.Addon()
+def write_token_file(token: AmazonToken) -> None:
+    path = profile_path("token.json")
+    atomic_write(path, json.dumps(token.to_dict()).encode())
 
-    path = os.path.join(addon.getAddonInfo("profile"), "token.json")
-    path = xbmcvfs.translatePath(path)
 
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+def read_token_file() -> AmazonToken:
+    path = profile_path("token.json")
 
     if not os.path.exists(path):
         return None
@@ -44,24 +171,140 @@ def load_token() -> AmazonToken:
     with open(path) as f:
         data = json.load(f)
 
-    return AmazonToken(
-        data["access"], data["refresh"], data["expires"], data["cookies"]
-    )
+    return AmazonToken.from_dict(data)
+
+
+def remove_token_file() -> None:
+    path = profile_path("token.json")
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def save_token(token: AmazonToken) -> None:
+    if broker is not None:
+        broker.save(token)
+        return
+
+    try:
+        broker_request("POST", data=token.to_dict())
+    except (OSError, ValueError):
+        write_token_file(token)
+
+
+def load_token() -> AmazonToken:
+    if broker is not None:
+        return broker.get()
+
+    try:
+        data = broker_request("GET")
+    except (OSError, ValueError):
+        return read_token_file()
+
+    if data["token"] is None:
+        return None
+
+    return AmazonToken.from_dict(data["token"])
+
+
+# Asks the broker for a token that is valid for at least margin more
+# seconds. The broker refreshes it at most once, no matter how many
+# invocations ask for it at the same time. Returns None if the broker
+# can't be reached, in which case AmazonAuth refreshes the token itself.
+def refresh_token(
+    url: AmazonURL, use_cookies: bool, margin: float = 0
+) -> AmazonToken:
+    if broker is not None:
+        return broker.refresh(url, use_cookies, margin)
+
+    query = {
+        "domain": url.domain,
+        "cookies": "1" if use_cookies else "0",
+        "margin": margin,
+    }
+
+    try:
+        data = broker_request("GET", query=query)
+    except (OSError, ValueError):
+        return None
+
+    if data["token"] is None:
+        return None
+
+    return AmazonToken.from_dict(data["token"])
 
 
 def clear_token() -> None:
-    addon = xbmcaddon.Addon()
+    if broker is not None:
+        broker.clear()
+    else:
+        try:
+            broker_request("DELETE")
+        except (OSError, ValueError):
+            remove_token_file()
+
+    # The cached endpoint belongs to the account that just logged out
+    clear_endpoint()
+
+
+def account_key(token: AmazonToken) -> str:
+    data = device_id() + "#" + token.refresh
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def save_endpoint(key: str, url: AmazonURL, marketplace: str) -> None:
+    path = profile_path("endpoint.json")
+
+    data = {
+        "key": key,
+        "time": time.time(),
+        "domain": url.domain,
+        "api": url.api,
+        "marketplace": marketplace,
+    }
+
+    atomic_write(path, json.dumps(data).encode())
 
-    path = os.path.join(addon.getAddonInfo("profile"), "token.json")
-    path = xbmcvfs.translatePath(path)
+
+def load_endpoint(key: str) -> Tuple[AmazonURL, str, float]:
+    path = profile_path("endpoint.json")
 
     if not os.path.exists(path):
-        return
+        return None
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except ValueError:
+        return None
+
+    # The cache was created for a different account or device
+    if data.get("key") != key:
+        return None
 
-    os.remove(path)
+    url = AmazonURL(data["domain"], data["api"])
+    age = time.time() - data["time"]
+
+    return url, data["marketplace"], age
+
+
+def clear_endpoint() -> None:
+    path = profile_path("endpoint.json")
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# The device ID never changes, so it is only read once per process
+serial = None
 
 
 def device_id() -> str:
+    global serial
+
+    if serial is not None:
+        return serial
+
     addon = xbmcaddon.Addon()
 
     path = os.path.join(addon.getAddonInfo("profile"), "deviceID.txt")
@@ -81,11 +324,134 @@ def device_id() -> str:
     return serial
 
 
-def device_type() -> str:
-    if xbmc.getCondVisibility("system.platform.android"):
-        return DEVICE_TYPE_ANDROID
+# Settings that switch off a stage of the manifest patching
+STAGE_SETTINGS = {
+    "mpd_split_audio": "split_adaptation_sets",
+    "mpd_audio_metadata": "patch_audio_metadata",
+    "mpd_subtitles": "add_subtitles",
+}
+
+
+# A snapshot of all settings and device capabilities that are needed on
+# the hot paths. Plugin invocations create it once, the service keeps it
+# until Kodi reports that the settings changed.
+class Settings:
+    device_type: str
+    hdr: List[str]
+    codecs: List[str]
+    resolution: str
+    prefer_atmos: bool
+    proxy_workers: int
+    compress_responses: bool
+    skip_stages: FrozenSet[str]
+    profile_cpu: bool
+    profile_memory: bool
+    profile_keep: int
+
+    def __init__(self):
+        addon = xbmcaddon.Addon()
+
+        if xbmc.getCondVisibility("system.platform.android"):
+            self.device_type = DEVICE_TYPE_ANDROID
+        else:
+            self.device_type = DEVICE_TYPE_BROWSER
+
+        self.hdr = []
+
+        if addon.getSettingBool("enable_dovi"):
+            self.hdr.append("DolbyVision")
+
+        if addon.getSettingBool("enable_hdr10"):
+            self.hdr.append("Hdr10")
+
+        if len(self.hdr) == 0:
+            self.hdr.append("None")
+
+        h265 = addon.getSettingInt("enable_h265")
+        self.codecs = ["H264"]
+
+        if h265 == 1:
+            self.codecs.append("H265")
+
+        # NOTE: The following is supported by the API
+        #
+        #  self.codecs.append("AV1")
+        #
+        # But I am not sure if there are any titles
+        # with an AV1 stream.
+
+        # Android devices with Widevine L1 can decrypt UHD streams
+        # TODO: Check if Android devices with L3 fallback gracefully
+        #
+        # H265 is required for UHD streams, so if it is disabled,
+        # only HD content (up to 1080p) can be requested.
+        #
+        # Other platforms (PC) can only get SD streams
+        # Higher quality requires VMP verification
+        if self.device_type != DEVICE_TYPE_ANDROID:
+            self.resolution = "SD"
+        elif h265 == 2:
+            self.resolution = "HD"
+        else:
+            self.resolution = "UHD"
+
+        # "Prefer Dolby Atmos":
+        #       Choose the Atmos track, even if a
+        #       track with a higher bitrate exists
+        #
+        # "Prefer higher bitrate":
+        #       Choose the track with the highest bitrate, even
+        #       if a Dolby Atmos track with lower bitrate exists.
+        self.prefer_atmos = addon.getSettingInt("audio_prefs") == 0
+
+        self.proxy_workers = max(1, addon.getSettingInt("proxy_workers"))
+
+        # Whether the proxy compresses its responses for clients that
+        # accept it. IS.A is always on the same host, so this is off by
+        # default. The ratio and CPU time in /metrics show whether it
+        # pays off on a device.
+        self.compress_responses = addon.getSettingBool("proxy_compress")
+
+        # Stages of the manifest patching that are switched off on this
+        # device, see mpd.PIPELINE. The absolute URLs are always needed.
+        self.skip_stages = frozenset(
+            stage
+            for setting, stage in STAGE_SETTINGS.items()
+            if not addon.getSettingBool(setting)
+        )
+
+        # Profiling can also be turned on without the settings dialog,
+        # for example TMSP_PROFILE=cpu,memory in the environment of Kodi
+        env = os.environ.get("TMSP_PROFILE", "").split(",")
+
+        self.profile_cpu = addon.getSettingBool("profile_cpu") or "cpu" in env
+        self.profile_memory = addon.getSettingBool("profile_memory") or "memory" in env
+        self.profile_keep = max(1, addon.getSettingInt("profile_keep"))
+
+
+settings = None
+settings_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    global settings
+
+    with settings_lock:
+        if settings is None:
+            settings = Settings()
+
+        return settings
+
 
-    return DEVICE_TYPE_BROWSER
+def invalidate_settings() -> None:
+    global settings
+
+    with settings_lock:
+        settings = None
+
+
+def device_type() -> str:
+    return get_settings().device_type
 
 
 def is_android() -> bool:
@@ -97,65 +463,28 @@ def is_browser() -> bool:
 
 
 def supported_hdr() -> List[str]:
-    addon = xbmcaddon.Addon()
-    hdr = []
-
-    if addon.getSettingBool("enable_dovi"):
-        hdr.append("DolbyVision")
-
-    if addon.getSettingBool("enable_hdr10"):
-        hdr.append("Hdr10")
-
-    if len(hdr) == 0:
-        hdr.append("None")
-
-    return hdr
+    return get_settings().hdr
 
 
 def supported_codecs() -> List[str]:
-    addon = xbmcaddon.Addon()
-    codecs = ["H264"]
+    return get_settings().codecs
 
-    if addon.getSettingInt("enable_h265") == 1:
-        codecs.append("H265")
 
-    # NOTE: The following is supported by the API
-    #
-    #  codecs.append("AV1")
-    #
-    # But I am not sure if there are any titles
-    # with an AV1 stream.
+def supported_resolution() -> str:
+    return get_settings().resolution
 
-    return codecs
 
+def prefer_atmos() -> bool:
+    return get_settings().prefer_atmos
 
-def supported_resolution() -> str:
-    addon = xbmcaddon.Addon()
 
-    # Android devices with Widevine L1 can decrypt UHD streams
-    # TODO: Check if Android devices with L3 fallback gracefully
-    #
-    # H265 is required for UHD streams, so if it is disabled,
-    # only HD content (up to 1080p) can be requested.
-    if is_android():
-        if addon.getSettingInt("enable_h265") == 2:
-            return "HD"
-        else:
-            return "UHD"
+def proxy_workers() -> int:
+    return get_settings().proxy_workers
 
-    # Other platforms (PC) can only get SD streams
-    # Higher quality requires VMP verification
-    return "SD"
 
+def compress_responses() -> bool:
+    return get_settings().compress_responses
 
-def prefer_atmos() -> str:
-    addon = xbmcaddon.Addon()
 
-    # "Prefer Dolby Atmos":
-    #       Choose the Atmos track, even if a
-    #       track with a higher bitrate exists
-    #
-    # "Prefer higher bitrate":
-    #       Choose the track with the highest bitrate, even
-    #       if a Dolby Atmos track with lower bitrate exists.
-    return addon.getSettingInt("audio_prefs") == 0
+def skip_stages() -> FrozenSet[str]:
+    return get_settings().skip_stages
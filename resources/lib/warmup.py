@@ -0,0 +1,78 @@
+import threading
+import time
+from typing import *
+
+import xbmc
+
+from .api import get_session
+from .endpoint import get_endpoint
+from .utils import *
+
+# Failed warm-ups (usually because the network is not up yet)
+# are repeated after this many seconds
+WARMUP_RETRY = 30
+PRECONNECT_TIMEOUT = 5
+
+
+def preconnect(url: str) -> None:
+    # Any response will do, the point is to have an
+    # open connection to the host in the pool
+    resp = get_session().head(url, timeout=PRECONNECT_TIMEOUT)
+    resp.close()
+
+
+# Prepares everything the first playback needs: the resolved endpoint
+# and open connections to the Amazon hosts. The token is kept fresh by
+# the RefreshScheduler. Returns False if it should be tried again later.
+def warm_up() -> bool:
+    token = load_token()
+    if token is None:
+        return True
+
+    try:
+        url, _ = get_endpoint(token)
+
+        preconnect("https://{}/".format(url.api))
+        preconnect("https://api.{}/".format(url.domain))
+    except Exception as e:
+        log("Warm-up failed: {}".format(e), xbmc.LOGWARNING)
+        return False
+
+    log("Warm-up done", xbmc.LOGDEBUG)
+    return True
+
+
+# Runs warm_up() on a thread of its own, so that a network that is only
+# half up never keeps the service loop from noticing that Kodi wants to
+# stop it. Only one warm-up runs at a time.
+class WarmUp:
+    pending: bool
+    retry: float
+    thread: threading.Thread
+
+    def __init__(self):
+        self.pending = True
+        self.retry = 0
+        self.thread = None
+
+    # Warms up again as soon as possible, for example after a suspend
+    def request(self) -> None:
+        self.pending = True
+        self.retry = 0
+
+    def poll(self) -> None:
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        if not self.pending or time.monotonic() < self.retry:
+            return
+
+        self.pending = False
+        self.retry = time.monotonic() + WARMUP_RETRY
+
+        self.thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        if not warm_up():
+            self.pending = True
@@ -1,13 +1,83 @@
-import xbmc
 import threading
+from urllib.parse import parse_qs, urlparse
+
+import xbmc
+
+from resources.lib.proxy import HOST, PORT, broker, sessions, start_proxy, stop_proxy
+from resources.lib.scheduler import RefreshScheduler
+from resources.lib.utils import invalidate_settings
+from resources.lib.warmup import WarmUp
+
+
+class ServiceMonitor(xbmc.Monitor):
+    def __init__(self):
+        super().__init__()
+        self.wake = threading.Event()
+
+    # The proxy reads the settings from a cached snapshot
+    def onSettingsChanged(self) -> None:
+        invalidate_settings()
+
+    # Connections and tokens are likely stale after a suspend
+    def onNotification(self, sender: str, method: str, data: str) -> None:
+        if method == "System.OnWake":
+            self.wake.set()
+
+
+# Drops the playback session of the proxy when Kodi stops playing it
+class ServicePlayer(xbmc.Player):
+    def __init__(self):
+        super().__init__()
+        self.session = None
+
+    def onAVStarted(self) -> None:
+        url = urlparse(self.getPlayingFile())
+
+        session = None
+        if url.netloc == "{}:{}".format(HOST, PORT) and url.path == "/mpd":
+            session = parse_qs(url.query).get("session", [None])[0]
+
+        # Kodi doesn't always report the end of the previous item
+        # when the next one is started directly
+        if session != self.session:
+            self.stop_session()
+
+        self.session = session
+
+    def stop_session(self) -> None:
+        if self.session is not None:
+            sessions.remove(self.session)
+            self.session = None
+
+    def onPlayBackStopped(self) -> None:
+        self.stop_session()
+
+    def onPlayBackEnded(self) -> None:
+        self.stop_session()
+
+    def onPlayBackError(self) -> None:
+        self.stop_session()
 
-from resources.lib.proxy import start_proxy, stop_proxy
 
 thread = threading.Thread(target=start_proxy)
 thread.start()
 
-monitor = xbmc.Monitor()
-monitor.waitForAbort()
+monitor = ServiceMonitor()
+player = ServicePlayer()
+scheduler = RefreshScheduler(broker)
+warmup = WarmUp()
+
+while not monitor.abortRequested():
+    if monitor.wake.is_set():
+        monitor.wake.clear()
+        warmup.request()
+
+    warmup.poll()
+
+    scheduler.poll()
+
+    if monitor.waitForAbort(1):
+        break
 
 stop_proxy()
 thread.join()